@@ -23,6 +23,7 @@
     along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import multiprocessing
 from flask import Flask
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
@@ -37,10 +38,29 @@ def init_database():
     init_db()
 
 
+def init_search():
+    """Load the search box term index and prepare the book search."""
+    from bpslibrary.database import db_session
+    from bpslibrary.utils.booksearch import init_book_search
+    from bpslibrary.utils.isbnkeys import init_isbn_keys
+    from bpslibrary.utils.termindex import init_term_index
+    init_term_index(db_session())
+    init_book_search(db_session())
+    init_isbn_keys(db_session())
+    db_session.remove()
+
+
+def register_commands():
+    """Register the flask command line commands."""
+    from bpslibrary.utils.thumbnails import backfill_thumbnails
+    app.cli.add_command(backfill_thumbnails)
+
+
 def register_views():
     """Register the flask blueprint views."""
-    from bpslibrary.views import books, index, users, loans
+    from bpslibrary.views import books, diagnostics, index, users, loans
     app.register_blueprint(books.mod)
+    app.register_blueprint(diagnostics.mod)
     app.register_blueprint(index.mod)
     app.register_blueprint(users.mod)
     app.register_blueprint(loans.mod)
@@ -58,18 +78,28 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'users.login'
 
-# initialise database
-init_database()
+# the barcode decoding processes import the package for the scanner only,
+# see bpslibrary.utils.decoding, and leave the database alone
+if multiprocessing.current_process().name == 'MainProcess':
+    # initialise database
+    init_database()
+
+    # load the search terms
+    init_search()
 
-# register the views
-register_views()
+    # register the views
+    register_views()
+
+    # register the commands
+    register_commands()
 
 
 @login_manager.user_loader
 def load_user(userid):
     """The callback for reloading a user from the session."""
-    from bpslibrary.models import User
-    return User.query.filter(User.id == int(userid)).first()
+    from bpslibrary.database import db_session
+    from bpslibrary.utils.identity import identity_cache
+    return identity_cache.get(db_session(), int(userid))
 
 
 @app.teardown_appcontext
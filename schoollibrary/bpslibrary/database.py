@@ -1,12 +1,156 @@
 
-from flask import Flask
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
+import random
+import time
+from functools import wraps
+from flask import Flask, has_request_context, request
+from flask import session as flask_session
+from sqlalchemy import create_engine, event, inspect, pool, text
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from bpslibrary import app
 
-engine = create_engine(app.config['DATABASE_URI'], echo=True)
-db_session = scoped_session(sessionmaker(autocommit=False,
+
+def create_db_engine(config, uri=None):
+    """Create the database engine as set in `config`.
+
+    :param config: (dict)
+    The application config, see the database section of
+    `bpslibrary_config`.
+
+    :param uri: (str)
+    The database to connect to, defaults to `DATABASE_URI`.
+    """
+    options = {
+        'echo': config.get('DATABASE_ECHO', False),
+        'connect_args': config.get('DATABASE_CONNECT_OPTIONS', {}),
+        'pool_recycle': config.get('DATABASE_POOL_RECYCLE', -1),
+    }
+
+    pool_class = config.get('DATABASE_POOL_CLASS')
+    if pool_class:
+        options['poolclass'] = getattr(pool, pool_class)
+        if options['poolclass'] is pool.QueuePool:
+            options['pool_size'] = config.get('DATABASE_POOL_SIZE', 5)
+            options['max_overflow'] = \
+                config.get('DATABASE_POOL_MAX_OVERFLOW', 10)
+
+    db_engine = create_engine(uri or config['DATABASE_URI'], **options)
+
+    pragmas = config.get('SQLITE_PRAGMAS')
+    if db_engine.dialect.name == 'sqlite' and pragmas:
+        event.listen(db_engine, 'connect',
+                     lambda conn, record: apply_pragmas(conn, pragmas))
+
+    return db_engine
+
+
+def apply_pragmas(dbapi_connection, pragmas):
+    """Set the sqlite `pragmas` on a new DBAPI connection."""
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute('PRAGMA %s = %s;' % (name, value))
+    cursor.close()
+
+
+def get_db_diagnostics(db_engine):
+    """Return the effective settings of `db_engine` as a dict."""
+    diagnostics = {
+        'url': repr(db_engine.url),
+        'dialect': db_engine.dialect.name,
+        'echo': db_engine.echo,
+        'pool_class': type(db_engine.pool).__name__,
+        'pool_status': db_engine.pool.status(),
+    }
+
+    if db_engine.dialect.name == 'sqlite':
+        pragmas = {}
+        with db_engine.connect() as connection:
+            for name in app.config.get('SQLITE_PRAGMAS') or {}:
+                pragmas[name] = connection.execute(
+                    'PRAGMA %s;' % name).scalar()
+        diagnostics['sqlite_pragmas'] = pragmas
+
+    return diagnostics
+
+
+class RoutingSession(Session):
+    """A session sending the reads of read-only views to read engines.
+
+    Reads go to a random engine of `read_engines` while the session is
+    flagged `read_only` (see :func:`read_only`) and has not written;
+    flushes and everything else go to the primary bind.
+    """
+
+    read_engines = []
+
+    def get_bind(self, mapper=None, clause=None):
+        """Return the engine for the next statement."""
+        if self.read_engines and self.info.get('read_only') \
+           and not self.info.get('has_written') and not self._flushing:
+            return random.choice(self.read_engines)
+        return super().get_bind(mapper, clause)
+
+
+def _after_flush(db_sess, flush_context):
+    """Route the rest of the session to the primary after a write."""
+    db_sess.info['has_written'] = True
+
+
+def _after_commit(db_sess):
+    """Make the user session read its own writes for a while."""
+    if db_sess.info.pop('has_written', False) and has_request_context():
+        flask_session['db_written_at'] = time.time()
+
+
+def _after_rollback(db_sess, previous_transaction):
+    """Forget the writes of a rolled back transaction."""
+    db_sess.info.pop('has_written', None)
+
+
+def read_only(func):
+    """View decorator to read from the read engines on GET requests.
+
+    Requests made shortly after a write in the same user session keep
+    reading the primary, so users always see their own changes.
+
+    Example::
+
+        @app.route('/view')
+        @read_only
+        def view():
+            pass
+
+    :param func: The view function to decorate.
+    :type func: function
+    """
+    @wraps(func)
+    def decorated_view(*args, **kwargs):
+        """"""
+        sticky_seconds = app.config['DATABASE_STICKY_SECONDS']
+        written_at = flask_session.get('db_written_at', 0)
+        if request.method not in ('GET', 'HEAD') or \
+           time.time() - written_at < sticky_seconds:
+            return func(*args, **kwargs)
+
+        db_sess = db_session()
+        db_sess.info['read_only'] = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            db_sess.info.pop('read_only', None)
+
+    return decorated_view
+
+
+engine = create_db_engine(app.config)
+RoutingSession.read_engines = [
+    create_db_engine(app.config, uri)
+    for uri in app.config.get('DATABASE_READ_URIS') or []]
+event.listen(RoutingSession, 'after_flush', _after_flush)
+event.listen(RoutingSession, 'after_commit', _after_commit)
+event.listen(RoutingSession, 'after_soft_rollback', _after_rollback)
+db_session = scoped_session(sessionmaker(class_=RoutingSession,
+                                         autocommit=False,
                                          autoflush=False,
                                          bind=engine))
 Model = declarative_base(name='Model')
@@ -17,6 +161,61 @@ def init_db():
     """Initialise the database."""
     from bpslibrary.models import Model as md
     md.metadata.create_all(bind=engine)
+    added_columns = upgrade_db(md.metadata)
+
+    if ('books', 'open_loan_id') in added_columns:
+        sync_open_loans()
+
+
+def upgrade_db(metadata):
+    """Add the columns and indexes missing from existing tables.
+
+    `create_all` only creates missing tables, so columns and indexes
+    introduced after a table was first created are added here.
+    Returns a set of (table, column) pairs of the added columns.
+    """
+    inspector = inspect(engine)
+    added_columns = set()
+
+    for table in metadata.sorted_tables:
+        columns = [c['name'] for c in inspector.get_columns(table.name)]
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                table.name, column.name,
+                column.type.compile(dialect=engine.dialect)))
+            added_columns.add((table.name, column.name))
+
+        if engine.dialect.name == 'sqlite':
+            # indexes on expressions are not reflected by sqlite
+            indexes = [row[0] for row in engine.execute(
+                text("SELECT name FROM sqlite_master "
+                     "WHERE type = 'index' AND tbl_name = :table"),
+                table=table.name)]
+        else:
+            indexes = [i['name'] for i in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(bind=engine)
+
+    return added_columns
+
+
+def sync_open_loans():
+    """Recompute the open loan pointers of all books from the loans."""
+    engine.execute(text("""
+        UPDATE books
+        SET
+            open_loan_id = (SELECT max(l.id) FROM loans l
+                            WHERE l.book_id = books.id
+                            AND l.end_date IS NULL),
+            current_pupil_id = (SELECT l.pupil_id FROM loans l
+                                WHERE l.book_id = books.id
+                                AND l.end_date IS NULL
+                                ORDER BY l.id DESC
+                                LIMIT 1);
+        """))
 
 
 def get_classroom_names():
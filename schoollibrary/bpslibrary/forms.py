@@ -2,9 +2,11 @@
 
 
 from wtforms.fields import (StringField, PasswordField, SelectField,
-                            IntegerField, BooleanField, FileField)
-from wtforms.validators import Optional, DataRequired
+                            IntegerField, BooleanField, FileField,
+                            MultipleFileField)
+from wtforms.validators import Optional, DataRequired, Length
 from flask_wtf import FlaskForm
+from bpslibrary import app
 
 
 class LoginForm(FlaskForm):
@@ -34,9 +36,9 @@ class NewAccessForm(FlaskForm):
 
 
 class NewLoanForm(FlaskForm):
-    """Form for book loans."""
+    """Form for book loans, of the scanned book if no book_id is given."""
 
-    book_id = IntegerField(validators=[DataRequired()])
+    book_id = IntegerField(validators=[Optional()])
     book_isbn = StringField(label='ISBN', validators=[DataRequired()])
     user_id = IntegerField(validators=[DataRequired()])
     pupil_id = SelectField(label='Pupil',
@@ -50,15 +52,29 @@ class NewLoanForm(FlaskForm):
 
 
 class LoanReturnForm(FlaskForm):
-    """Form for returning books."""
+    """Form for returning books, the scanned book if no book_id is given."""
 
-    book_id = IntegerField(validators=[DataRequired()])
+    book_id = IntegerField(validators=[Optional()])
     barcode_img = FileField(label='Scan Barcode',
                             validators=[DataRequired()],
                             description="Take a picture using tablet/phone " +
                             "camera or upload and image of the barcode.")
 
 
+class BulkReturnForm(FlaskForm):
+    """Form for returning many books at once."""
+
+    barcode_imgs = MultipleFileField(
+        label='Scan Barcodes',
+        validators=[DataRequired(),
+                    Length(max=app.config['BARCODE_BULK_MAX_FILES'],
+                           message="Please upload at most %(max)d "
+                           "pictures at a time.")],
+        description="Take pictures of the barcodes, one or several " +
+        "books per picture, up to %d pictures at a time." %
+        app.config['BARCODE_BULK_MAX_FILES'])
+
+
 class UpdateLoanPeriod(FlaskForm):
     """A form for updating the default loan period."""
 
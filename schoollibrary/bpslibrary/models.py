@@ -4,12 +4,13 @@
 # pylint: disable=R0903
 
 from sqlalchemy import (Column, String, Integer, Sequence,
-                        ForeignKey, Table, Boolean, Date)
-from sqlalchemy.orm import relationship
+                        ForeignKey, Table, Boolean, Date, DateTime, Index,
+                        func, text)
+from sqlalchemy.orm import object_session, relationship, selectinload
 from sqlalchemy.ext.hybrid import hybrid_property
 from flask_login import UserMixin
-from bpslibrary import bcrypt
 from bpslibrary.database import Model
+from bpslibrary.utils.passwords import password_hasher
 
 
 # Associations
@@ -50,10 +51,11 @@ class Classroom(Model):
     @property
     def open_loans(self):
         """Open loans for pupils of this classroom."""
-        loans = []
-        for pupil in self.pupils:
-            loans += [loan for loan in pupil.loans if not loan.end_date]
-        return loans
+        return object_session(self).query(Loan).\
+            join(Loan.pupil).\
+            filter(Pupil.classroom_id == self.id,
+                   Loan.end_date.is_(None)).\
+            all()
 
     def __init__(self, name):
         """Initialise new Classroom object."""
@@ -133,6 +135,19 @@ class Settings(Model):
     loan_period = Column(Integer, nullable=False)
 
 
+class CatalogueVersion(Model):
+    """The version of the catalogue terms, shared by all processes.
+
+    See bpslibrary.utils.termindex.
+    """
+
+    __tablename__ = 'catalogue_version'
+    __table_args__ = {'extend_existing': True}
+    id = Column(Integer, primary_key=True)
+    # columns
+    version = Column(Integer, nullable=False, default=0)
+
+
 class Author(Model):
     """A book author."""
 
@@ -166,7 +181,11 @@ class Book(Model):
 
     # orm required fields
     __tablename__ = 'books'
-    __table_args__ = {'extend_existing': True}
+    __table_args__ = (
+        # keyset pagination of listings, see utils.pagination
+        Index('ix_books_title_id', 'title', 'id'),
+        Index('ix_books_available_title_id', 'is_available', 'title', 'id'),
+        {'extend_existing': True})
 
     # columns
     id = Column(Integer,
@@ -183,6 +202,13 @@ class Book(Model):
     current_location = Column(String)
     image_name = Column(String)
 
+    # denormalised pointers to the open loan, maintained on loan/return
+    open_loan_id = Column(Integer,
+                          ForeignKey('loans.id', use_alter=True,
+                                     name='fk_books_open_loan_id'),
+                          index=True)
+    current_pupil_id = Column(Integer, ForeignKey('pupils.id'), index=True)
+
     # relationships
     categories = relationship('Category',
                               secondary=book_category,
@@ -191,7 +217,18 @@ class Book(Model):
     authors = relationship('Author',
                            secondary=book_author,
                            back_populates='books')
-    loans = relationship('Loan', back_populates='book')
+    loans = relationship('Loan',
+                         back_populates='book',
+                         foreign_keys='Loan.book_id')
+    open_loan = relationship('Loan',
+                             foreign_keys=[open_loan_id],
+                             post_update=True)
+    current_pupil = relationship('Pupil')
+    open_loans = relationship('Loan',
+                              primaryjoin='and_(Book.id == Loan.book_id, '
+                              'Loan.end_date.is_(None))',
+                              order_by='Loan.id.desc()',
+                              viewonly=True)
 
     @property
     def authors_names(self):
@@ -219,10 +256,17 @@ class Book(Model):
     @property
     def current_loan(self):
         """Open loan currently."""
-        current_loan = [loan for loan in
-                        sorted(self.loans, key=lambda l: l.id, reverse=True)
-                        if not loan.end_date]
-        return current_loan[0] if current_loan else None
+        return self.open_loan
+
+    def is_loaned_to(self, classroom):
+        """Check if the book is on loan to a pupil of `classroom`.
+
+        :param1: classroom (Classroom)
+        The classroom to check, may be None.
+        """
+        return classroom is not None and \
+            self.current_pupil is not None and \
+            self.current_pupil.classroom_id == classroom.id
 
     def __repr__(self):
         """Book object representation."""
@@ -237,7 +281,6 @@ class User(Model, UserMixin):
 
     # orm fields
     __tablename__ = 'users'
-    __table_args__ = {'extend_existing': True}
 
     # columns
     id = Column(Integer,
@@ -247,6 +290,11 @@ class User(Model, UserMixin):
     _password = Column(String(128), nullable=False)
     is_admin = Column(Boolean)
 
+    __table_args__ = (
+        # case insensitive username lookups, see views.users.login
+        Index('ix_users_username_lower', func.lower(username)),
+        {'extend_existing': True})
+
     # relationships
     classroom = relationship('Classroom', back_populates='user', uselist=False)
 
@@ -256,13 +304,13 @@ class User(Model, UserMixin):
         return self._password
 
     @password.setter
-    def _set_password(self, password_text):
+    def password(self, password_text):
         """Set the password property after hashing it.
 
         :param1: password_text (str)
         The password to be hashed.
         """
-        self._password = bcrypt.generate_password_hash(password_text)
+        self._password = password_hasher.hash(password_text)
 
     def is_correct_password(self, password_text):
         """Check the hash of password_text against the saved hash.
@@ -270,7 +318,12 @@ class User(Model, UserMixin):
         :param1: password_text (str)
         The password to check.
         """
-        return bcrypt.check_password_hash(self._password, password_text)
+        return password_hasher.verify(self._password, password_text)
+
+    @property
+    def password_needs_rehash(self):
+        """Whether the hash is not at the current cost."""
+        return password_hasher.needs_rehash(self._password)
 
     def get_id(self):
         """Retrieve the user by id."""
@@ -282,7 +335,12 @@ class Loan(Model):
 
     # orm fields
     __tablename__ = 'loans'
-    __table_args__ = {'extend_existing': True}
+    __table_args__ = (
+        # open loans of a book, see Book.open_loan_id
+        Index('ix_loans_open_book_id', 'book_id',
+              sqlite_where=text('end_date IS NULL'),
+              postgresql_where=text('end_date IS NULL')),
+        {'extend_existing': True})
     id = Column(Integer,
                 Sequence('loans_seq', start=0, increment=1),
                 primary_key=True)
@@ -290,7 +348,10 @@ class Loan(Model):
     pupil_id = Column(Integer, ForeignKey('pupils.id'))
     pupil = relationship('Pupil', back_populates='loans', uselist=False)
     book_id = Column(Integer, ForeignKey('books.id'))
-    book = relationship('Book', back_populates='loans', uselist=False)
+    book = relationship('Book',
+                        back_populates='loans',
+                        foreign_keys=[book_id],
+                        uselist=False)
 
     start_date = Column(Date, nullable=False)
     end_date = Column(Date, nullable=True)
@@ -299,3 +360,80 @@ class Loan(Model):
         """Loan object representation."""
         return "<Loan %d (book %d) %s-%s" %\
             (self.id, self.book_id, self.start_date, self.end_date)
+
+
+class IsbnLookup(Model):
+    """An ISBN queued for automated book loading."""
+
+    # orm fields
+    __tablename__ = 'isbn_lookup'
+    __table_args__ = (
+        # the next isbns to look up, see bpslibrary.utils.autoload
+        Index('ix_isbn_lookup_status_last_check', 'status', 'last_check'),
+        {'extend_existing': True})
+    # the table predates the orm mapping and has no key of its own
+    isbn = Column(String(13), primary_key=True)
+
+    status = Column(String(30))
+    last_check = Column(DateTime)
+    # superseded by lookup_errors
+    errors = Column(String(1024))
+
+    lookup_errors = relationship(
+        'IsbnLookupError',
+        primaryjoin='IsbnLookup.isbn == foreign(IsbnLookupError.isbn)',
+        order_by='IsbnLookupError.id',
+        viewonly=True)
+
+    def __repr__(self):
+        """IsbnLookup object representation."""
+        return "<IsbnLookup %s %s>" % (self.isbn, self.status)
+
+
+class IsbnLookupError(Model):
+    """The error of a failed lookup of an ISBN."""
+
+    # orm fields
+    __tablename__ = 'isbn_lookup_errors'
+    __table_args__ = {'extend_existing': True}
+    id = Column(Integer,
+                Sequence('isbn_lookup_errors_seq', start=0, increment=1),
+                primary_key=True)
+
+    isbn = Column(String(13), nullable=False, index=True)
+    checked_at = Column(DateTime, nullable=False)
+    message = Column(String, nullable=False)
+
+    def __repr__(self):
+        """IsbnLookupError object representation."""
+        return "<IsbnLookupError %s %s>" % (self.isbn, self.checked_at)
+
+
+class BookIsbn(Model):
+    """A normalised ISBN-13 key of a book, see bpslibrary.utils.isbnkeys."""
+
+    # orm fields
+    __tablename__ = 'book_isbns'
+    __table_args__ = {'extend_existing': True}
+    isbn = Column(String(13), primary_key=True)
+
+    book_id = Column(Integer, ForeignKey('books.id'), nullable=False,
+                     index=True)
+    # canonical, isbn10 or alias
+    kind = Column(String(10), nullable=False)
+
+    book = relationship('Book')
+
+    def __repr__(self):
+        """BookIsbn object representation."""
+        return "<BookIsbn %s %s %s>" % (self.isbn, self.book_id, self.kind)
+
+
+# Loader options
+# Relationships rendered for every book of a listing, loaded with one
+# query each for the whole page rather than one query per book.
+BOOK_LIST_OPTIONS = (
+    selectinload(Book.authors),
+    selectinload(Book.categories),
+    selectinload(Book.current_pupil),
+)
@@ -20,3 +20,14 @@ function updateElement(sourceEl, destEl)
 {
     $('#' + destEl).html($('#' + sourceEl).val())
 }
+
+function attachSearchSuggestions(inputEl, suggestUrl, options)
+{
+    $(inputEl).autocomplete($.extend({
+        source: function(request, response) {
+            $.getJSON(suggestUrl, {q: request.term}, response)
+                .fail(function() { response([]); });
+        },
+        minLength: 3
+    }, options));
+}
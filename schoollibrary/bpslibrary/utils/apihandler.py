@@ -1,16 +1,45 @@
 """Handle online APIs for relates ISBN and book info."""
 
+import json
 import re
+import threading
 import time
 import urllib.parse
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import pyisbn
 from bottlenose import Amazon
 from bs4 import BeautifulSoup
-from flask import flash
+from flask import flash, has_request_context
 from bpslibrary import app
 from bpslibrary.models import Author, Book, Category
+from bpslibrary.utils.httpclient import (http_get, provider_setting,
+                                         provider_slot, record_latency,
+                                         throttle)
+from bpslibrary.utils.lookupcache import lookup_cache
+from bpslibrary.utils.ratelimit import RateLimitExceeded
+
+
+# the parts of a volumes list response consumed by `build_book`
+GOOGLE_FIELDS = 'totalItems,items(volumeInfo(title,description,' + \
+    'industryIdentifiers,authors,categories,imageLinks,previewLink))'
+
+# the most items google returns per request
+GOOGLE_MAX_RESULTS = 40
+
+# the amazon error codes of an item that does not exist
+AMAZON_NOT_FOUND_CODES = {'AWS.InvalidParameterValue',
+                          'AWS.ECommerceService.NoExactMatches'}
+
+
+def isbn_key(isbn):
+    """Return the ISBN-13 form of `isbn`, or `isbn` if it is not valid."""
+    isbn = isbn.strip().replace('-', '')
+    try:
+        return pyisbn.convert(isbn) if len(isbn) == 10 else isbn
+    except ValueError:
+        return isbn
 
 
 def build_book(vol_info):
@@ -45,6 +74,21 @@ def build_book(vol_info):
     return book
 
 
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Return the thread pool running the lookups of all clients."""
+    global _executor  # pylint: disable=W0603
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=app.config['LOOKUP_MAX_WORKERS'],
+                thread_name_prefix='lookup')
+        return _executor
+
+
 class APIClient():
     """
     Online book information APIs handler.
@@ -60,9 +104,13 @@ class APIClient():
     :param2 book_title (str):
     A title of a book to lookup.
 
+    :param3 max_wait (float):
+    The most seconds to wait for a provider's rate limit; providers
+    further off are skipped. Waits as long as needed if not set.
+
     """
 
-    def __init__(self, isbn_list, book_title):
+    def __init__(self, isbn_list, book_title, max_wait=None):
         """Initialise an APIClient.
 
         :param1 isbn_list:
@@ -70,14 +118,19 @@ class APIClient():
 
         :param2 book_title:
         A title of a book to lookup.
+
+        :param3 max_wait:
+        The most seconds to wait for a provider's rate limit.
         """
         self.isbns = isbn_list if isbn_list else []
         self.book_title = book_title.strip() if book_title else ''
+        self.max_wait = max_wait
         self.google_key = app.config['GOOGLE_API_KEY']
         self.aws_access_key = app.config['AWS_ACCESS_KEY']
         self.aws_secret_key = app.config['AWS_SECRET_KEY']
         self.aws_associate_tag = app.config['AWS_ASSOCIATE_TAG']
         self.ebay_appname = app.config['EBAY_APPNAME']
+        self.errors = []
 
     def find_books(self, direct_search_only=False):
         """
@@ -96,57 +149,121 @@ class APIClient():
         :Title lookup:
         If provided, books will be also looked up on google books by title.
 
+        The title and the ISBNs are looked up concurrently on a shared
+        thread pool of `LOOKUP_MAX_WORKERS` threads, each ISBN following
+        the steps above in order.
+
         """
         found_books = []
-        lookup_results = []
-        errors = []
-
-        found_books += self.lookup_by_title()
-
-        if bool(self.isbns):
-            for isbn in self.isbns:
-                try:
-                    isbn = isbn.strip()
-
-                    # first search on google books
-                    lookup_results += self.search_google_books(isbn, None)
-
-                    # if not on google, search amazon
-                    if not lookup_results:
-                        lookup_results += self.search_amazon(isbn)
-
-                    # if dirct_search_only is not set, then try related
-                    # and title search
-                    if not direct_search_only and not lookup_results:
-                        lookup_results += self.lookup_by_related_isbn(isbn)
-
-                        if not lookup_results:
-                            lookup_results = self.lookup_by_title(
-                                self.lookup_title(isbn)
-                            )
-
-                    # ensure that all results have the targeted isbn
-                    # pylint: disable=C0200
-                    for i in range(len(lookup_results)):
-                        if len(isbn) == 13:
-                            lookup_results[i].isbn13 = isbn
-                            lookup_results[i].isbn10 = pyisbn.convert(isbn)
-                        else:
-                            lookup_results[i].isbn10 = isbn
-                            lookup_results[i].isbn13 = pyisbn.convert(isbn)
-
-                    found_books += lookup_results
-                except Exception as err:
-                    errors.append(
-                        time.strftime('%Y-%m-%d_%H:%M:%S - ') + str(err)
-                        )
-                    continue
+        errors = self.errors = []
+
+        # the title and every isbn are looked up concurrently, each isbn
+        # keeping the fallback order of `lookup_isbn`; several isbns are
+        # first searched on google together, which fills the lookup cache
+        isbns = [isbn.strip() for isbn in self.isbns]
+        futures = [get_executor().submit(self.lookup_by_title)]
+        if len(isbns) > 1:
+            self.search_google_books_batch(isbns)
+        futures += [get_executor().submit(self.lookup_isbn,
+                                          isbn,
+                                          direct_search_only)
+                    for isbn in isbns]
+
+        for future in futures:
+            try:
+                found_books += future.result()
+            except Exception as err:  # pylint: disable=W0703
+                errors.append(
+                    time.strftime('%Y-%m-%d_%H:%M:%S - ') + str(err)
+                    )
 
         found_books = sorted(set(found_books), key=lambda b: b.title)
-        if errors:
+        if errors and has_request_context():
             flash(errors)
         return found_books
 
+    def lookup_isbn(self, isbn, direct_search_only=False):
+        """
+        Lookup the details of a book by ISBN.
+
+        Google books is searched first, then amazon. Unless
+        `direct_search_only` is set, related ISBNs and finally the title
+        of the ISBN are looked up on google books.
+
+        :param1 isbn: (str)
+        The isbn to lookup.
+
+        :param2 direct_search_only: (bool)
+        Skip the related ISBN and title lookups.
+        """
+        # first search on google books
+        lookup_results = self.search_google_books(isbn, None)
+
+        # if not on google, search amazon
+        if not lookup_results:
+            lookup_results = self.search_amazon(isbn)
+
+        # if dirct_search_only is not set, then try related
+        # and title search
+        if not direct_search_only and not lookup_results:
+            lookup_results = self.lookup_by_related_isbn(isbn)
+
+            if not lookup_results:
+                lookup_results = self.lookup_by_title(
+                    self.lookup_title(isbn)
+                )
+
+        # ensure that all results have the targeted isbn
+        for book in lookup_results:
+            if len(isbn) == 13:
+                book.isbn13 = isbn
+                book.isbn10 = pyisbn.convert(isbn)
+            else:
+                book.isbn10 = isbn
+                book.isbn13 = pyisbn.convert(isbn)
+
+        return lookup_results
+
+    def skip_provider(self, err):
+        """Record a provider skipped for its rate limit."""
+        self.errors.append(time.strftime('%Y-%m-%d_%H:%M:%S - ') + str(err))
+
+    def cached_get(self, provider, query, url, is_negative):
+        """GET the text of `url` through the lookup cache.
+
+        :param1 provider: (str)
+        The provider name the response is cached under.
+
+        :param2 query: (str)
+        The query the response is cached under.
+
+        :param3 url: (str)
+        The url to GET on a cache miss.
+
+        :param4 is_negative: (callable)
+        Tells from the response text whether nothing was found; returns
+        None for errors reported in the text, which are not cached.
+
+        Returns None, skipping the provider, if its rate limit allows no
+        call within `max_wait`.
+        """
+        def lookup():
+            """GET `url`; error responses are not cached."""
+            response = http_get(url, self.max_wait)
+            # pylint: disable=E1101
+            if response.status_code != requests.codes.ok:
+                return None, False
+            negative = is_negative(response.text)
+            if negative is None:
+                return None, False
+            return response.text, negative
+
+        try:
+            return lookup_cache.fetch(provider, query, lookup)
+        except RateLimitExceeded as err:
+            self.skip_provider(err)
+            return None
+
     def search_google_books(self, isbn, title):
         """Look up a book on google books api.
 
@@ -154,8 +271,6 @@ class APIClient():
         of the API.
         (https://developers.google.com/books/docs/v1/reference/volumes/list)
         """
-        api_url = 'https://www.googleapis.com/books/v1/volumes?q={}' + \
-            '&printType=books&key=' + self.google_key
         search_query = ''
 
         if title and title.strip():
@@ -167,18 +282,20 @@ class APIClient():
         if not search_query:
             return []
 
-        search_result = requests.get(api_url.format(search_query))
+        search_result = self.cached_get(
+            'google', search_query, self.google_url(search_query),
+            lambda text: not json.loads(text).get('items'))
 
-        # pylint: disable=E1101
-        if search_result.status_code != requests.codes.ok:
+        if search_result is None:
             return []
 
-        if int(search_result.json().get('totalItems')) <= 0 or \
-           'items' not in search_result.json().keys():
+        search_result = json.loads(search_result)
+        if int(search_result.get('totalItems', 0)) <= 0 or \
+           'items' not in search_result.keys():
             return []
 
         found_books = []
-        for item in search_result.json().get('items'):
+        for item in search_result.get('items'):
 
             if 'volumeInfo' not in item.keys():
                 continue
@@ -189,6 +306,85 @@ class APIClient():
                 found_books.append(book)
         return found_books
 
+    def google_url(self, search_query, max_results=None):
+        """Return the volumes list url of `search_query`.
+
+        Only the fields read by `build_book` are requested when
+        `GOOGLE_BOOKS_PROJECTION` is set.
+        """
+        api_url = 'https://www.googleapis.com/books/v1/volumes?q=' + \
+            search_query + '&printType=books&key=' + self.google_key
+        if app.config['GOOGLE_BOOKS_PROJECTION']:
+            api_url += '&fields=' + urllib.parse.quote(GOOGLE_FIELDS)
+        if max_results:
+            api_url += '&maxResults=%d' % max_results
+        return api_url
+
+    def search_google_books_batch(self, isbns):
+        """Look up several ISBNs on google books with combined queries.
+
+        Up to `GOOGLE_BOOKS_BATCH_SIZE` ISBNs not in the lookup cache are
+        searched per `isbn:A OR isbn:B` request. The items are split back
+        per ISBN by their identifiers and cached as the response of that
+        ISBN's own query, so `search_google_books` is answered from the
+        cache afterwards. ISBNs matching no item are left to their own
+        query, which may find volumes listed under other identifiers.
+
+        :param1 isbns: (list)
+        The ISBNs to look up.
+        """
+        if not lookup_cache.path:
+            return
+
+        pending = [isbn for isbn in isbns if isbn and not lookup_cache.get(
+            'google', '+isbn:' + isbn)[0]]
+        batch_size = min(app.config['GOOGLE_BOOKS_BATCH_SIZE'],
+                         GOOGLE_MAX_RESULTS)
+
+        futures = [get_executor().submit(self._search_google_batch,
+                                         pending[i:i + batch_size])
+                   for i in range(0, len(pending), batch_size)]
+        for future in futures:
+            future.result()
+
+    def _search_google_batch(self, isbns):
+        """Search one batch of ISBNs, see `search_google_books_batch`."""
+        search_query = '+OR+'.join('isbn:' + isbn for isbn in isbns)
+        try:
+            response = http_get(self.google_url(search_query,
+                                                GOOGLE_MAX_RESULTS),
+                                self.max_wait)
+        except RateLimitExceeded as err:
+            self.skip_provider(err)
+            return
+
+        # pylint: disable=E1101
+        if response.status_code != requests.codes.ok:
+            return
+
+        items = {isbn_key(isbn): [] for isbn in isbns}
+        search_result = response.json()
+        for item in search_result.get('items', []):
+            identifiers = item.get('volumeInfo', {}).get(
+                'industryIdentifiers', [])
+            for key in {isbn_key(i.get('identifier', ''))
+                        for i in identifiers}:
+                if key in items:
+                    items[key].append(item)
+
+        # a partial page may have left out items of any isbn, and an isbn
+        # matching no item is not known to be missing, so only the matches
+        # of a complete answer are cached
+        if int(search_result.get('totalItems', 0)) > \
+           len(search_result.get('items', [])):
+            return
+        for isbn in isbns:
+            found = items[isbn_key(isbn)]
+            if found:
+                lookup_cache.set(
+                    'google', '+isbn:' + isbn,
+                    json.dumps({'totalItems': len(found), 'items': found}))
+
     def lookup_by_related_isbn(self, isbn):
         """
         Lookup related ISBN for the same work.
@@ -202,7 +398,9 @@ class APIClient():
         xisbn_url = 'http://xisbn.worldcat.org/webservices/xid/isbn/{}' + \
             '?method=getEditions&format=json'
 
-        xisbn_result = requests.get(xisbn_url.format(isbn)).json()
+        xisbn_result = self.cached_get(
+            'xisbn', isbn, xisbn_url.format(isbn), self.xisbn_negative)
+        xisbn_result = json.loads(xisbn_result) if xisbn_result else None
 
         if xisbn_result and xisbn_result.get('stat').lower() == 'ok':
             for risbn in xisbn_result.get('list'):
@@ -213,8 +411,12 @@ class APIClient():
 
         # libraryThing web service
         lib_thing_url = 'http://www.librarything.com/api/thingISBN/{}'
-        lt_result = ET.fromstring(
-            requests.get(lib_thing_url.format(isbn)).text)
+        lt_result = self.cached_get(
+            'librarything', isbn, lib_thing_url.format(isbn),
+            lambda text: '<isbn>' not in text)
+        if not lt_result:
+            return found_on_google
+        lt_result = ET.fromstring(lt_result)
 
         for data in lt_result.iter('isbn'):
             found_on_google += self.search_google_books(data.text, None)
@@ -222,6 +424,20 @@ class APIClient():
                 return found_on_google
         return found_on_google
 
+    @staticmethod
+    def xisbn_negative(text):
+        """Tell whether an xisbn response found no editions.
+
+        Returns None for errors such as `overlimit`, which say nothing
+        about the isbn.
+        """
+        stat = json.loads(text).get('stat', '').lower()
+        if stat == 'ok':
+            return False
+        if stat in ('unknownid', 'invalidid'):
+            return True
+        return None
+
     def lookup_title(self, isbn):
         """
         Lookup book title by ISBN.
@@ -234,8 +450,17 @@ class APIClient():
             '?OPERATION-NAME=findItemsAdvanced&RESPONSE-DATA-FORMAT=JSON' + \
             '&SECURITY-APPNAME=' + self.ebay_appname + \
             '&GLOBAL-ID=EBAY-GB&categoryId=267&keywords={}'
-        ebay_result = requests.get(ebay_url.format(isbn)).json()
+        ebay_result = self.cached_get(
+            'ebay', isbn, ebay_url.format(isbn),
+            lambda text: self.ebay_title(json.loads(text), isbn) is None)
 
+        if ebay_result:
+            return self.ebay_title(json.loads(ebay_result), isbn)
+        return None
+
+    @staticmethod
+    def ebay_title(ebay_result, isbn):
+        """Return the title of the first item of an ebay search result."""
         if ebay_result:
             response = ebay_result.get('findItemsAdvancedResponse')[0]
             if response.get('ack')[0].lower() == 'success' and \
@@ -262,17 +487,13 @@ class APIClient():
 
     def search_amazon(self, isbn):
         """Look up book info on amazon."""
-        amazon = Amazon(self.aws_access_key,
-                        self.aws_secret_key,
-                        self.aws_associate_tag,
-                        Region='UK',
-                        Parser=lambda text: BeautifulSoup(text))
-        result = amazon.ItemLookup(
-            ItemId=isbn,
-            ResponseGroup='EditorialReview,Images,ItemAttributes',
-            SearchIndex='Books',
-            IdType='EAN'
-        )
+        try:
+            result = lookup_cache.fetch(
+                'amazon', isbn, lambda: self.amazon_item_lookup(isbn))
+        except RateLimitExceeded as err:
+            self.skip_provider(err)
+            result = None
+        result = BeautifulSoup(result) if result else None
 
         found_books = []
         if result and not result.find('errors'):
@@ -295,15 +516,13 @@ class APIClient():
                     book.description = description_tag.text
             else:
                 if book.preview_url:
-                    desc_html = requests.get(book.preview_url)
-                    if desc_html and desc_html.text:
-                        desc_div = BeautifulSoup(desc_html.text).find(
-                            id="bookDescription_feature_div")
-                        if desc_div and desc_div.find('noscript'):
-                            desc_text = desc_div.find('noscript').text
-                            bool.description = re.sub(
-                                re.compile(r'<.*?>|\n|\t|\r|\s{2,10}'),
-                                '', desc_text)
+                    try:
+                        book.description = lookup_cache.fetch(
+                            'amazon_description', isbn,
+                            lambda: self.amazon_description(
+                                book.preview_url))
+                    except RateLimitExceeded as err:
+                        self.skip_provider(err)
 
             # thumbnail
             image_tag = result.find('largeimage')
@@ -319,3 +538,66 @@ class APIClient():
 
             found_books.append(book)
         return found_books
+
+    def amazon_item_lookup(self, isbn):
+        """Return the raw amazon ItemLookup response of `isbn`.
+
+        Returns a `(response, negative)` pair for the lookup cache; the
+        response is None for errors other than an unknown item.
+        """
+        amazon = Amazon(self.aws_access_key,
+                        self.aws_secret_key,
+                        self.aws_associate_tag,
+                        Region='UK',
+                        Timeout=provider_setting(
+                            'webservices.amazon.co.uk', 'timeout')[1])
+
+        throttle('webservices.amazon.co.uk', self.max_wait)
+        with provider_slot('webservices.amazon.co.uk'):
+            started = time.time()
+            try:
+                response = amazon.ItemLookup(
+                    ItemId=isbn,
+                    ResponseGroup='EditorialReview,Images,ItemAttributes',
+                    SearchIndex='Books',
+                    IdType='EAN'
+                )
+            finally:
+                record_latency('webservices.amazon.co.uk',
+                               time.time() - started)
+
+        if isinstance(response, bytes):
+            response = response.decode('utf-8')
+        negative = self.amazon_negative(response)
+        if negative is None:
+            return None, False
+        return response, negative
+
+    @staticmethod
+    def amazon_negative(text):
+        """Tell whether an amazon response found no item.
+
+        Returns None for errors such as throttling or bad credentials,
+        which say nothing about the isbn.
+        """
+        if '<Errors>' not in text:
+            return False
+        codes = set(re.findall(r'<Code>([^<]*)</Code>', text))
+        if codes and codes <= AMAZON_NOT_FOUND_CODES:
+            return True
+        return None
+
+    def amazon_description(self, preview_url):
+        """Scrape the book description from an amazon product page.
+
+        Returns a `(description, negative)` pair for the lookup cache.
+        """
+        desc_html = http_get(preview_url, self.max_wait)
+        if desc_html and desc_html.text:
+            desc_div = BeautifulSoup(desc_html.text).find(
+                id="bookDescription_feature_div")
+            if desc_div and desc_div.find('noscript'):
+                desc_text = desc_div.find('noscript').text
+                return re.sub(re.compile(r'<.*?>|\n|\t|\r|\s{2,10}'),
+                              '', desc_text), False
+        return '', True
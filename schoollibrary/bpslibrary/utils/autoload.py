@@ -0,0 +1,331 @@
+"""
+Autoload
+========
+
+Background bulk loading of the books listed in the `isbn_lookup` table.
+
+A job runs on a thread of the process that started it. It takes batches
+of ISBNs not yet loaded, looks every ISBN up online and adds the book if
+exactly one match is found. The status of each ISBN is written to
+`isbn_lookup` with the rest of its batch, so a job interrupted by a
+restart loses at most one batch and a new job carries on where it
+stopped. A job only takes ISBNs last checked before it started, so it
+tries every ISBN once.
+
+The progress of the job and its pause flag live in a small JSON state
+file, so every worker process can report on and pause or resume the job
+whichever process runs it.
+"""
+
+import fcntl
+import json
+import os
+import threading
+import time
+from sqlalchemy import String, bindparam, func, literal, not_, or_, select
+from bpslibrary import app
+from bpslibrary.utils.apihandler import APIClient
+from bpslibrary.utils.enums import BookLocation
+from bpslibrary.utils.httpclient import provider_latency
+from bpslibrary.utils.isbnkeys import resolve_isbn
+from bpslibrary.utils.thumbnails import thumbnail_service
+
+
+# seconds without a heartbeat after which a running job is presumed dead
+STALE_AFTER = 300
+
+# seconds between checks of the pause flag of a paused job
+PAUSE_POLL = 1
+
+
+def check_time():
+    """Return the database time, as the checks of `isbn_lookup` record it.
+    """
+    from bpslibrary.database import engine
+    return engine.scalar(select([func.current_timestamp(type_=String)]))
+
+
+def fetch_isbns(limit, checked_before=None):
+    """Return up to `limit` ISBNs not loaded yet, oldest checks first.
+
+    :param limit: (int)
+    The most ISBNs returned.
+
+    :param checked_before: (str)
+    A :func:`check_time`; ISBNs checked since are left out.
+    """
+    from bpslibrary.database import engine
+    from bpslibrary.models import IsbnLookup
+    table = IsbnLookup.__table__
+
+    query = select([table.c.isbn]).\
+        where(or_(table.c.status.is_(None),
+                  not_(table.c.status.like('%SUCCESS%'))))
+    if checked_before is not None:
+        query = query.where(
+            or_(table.c.last_check.is_(None),
+                table.c.last_check < literal(checked_before, String)))
+    query = query.group_by(table.c.isbn).\
+        order_by(func.min(table.c.last_check)).\
+        limit(limit)
+    return [row[0] for row in engine.execute(query)]
+
+
+def record_results(succeeded, failed):
+    """Write the lookup status of a batch of ISBNs in one transaction.
+
+    Each kind of statement is sent once for the whole batch.
+
+    :param succeeded: (list)
+    The ISBNs whose book was added.
+
+    :param failed: (list)
+    `(isbn, error)` pairs of the ISBNs whose book was not added.
+    """
+    from bpslibrary.database import engine
+    from bpslibrary.models import IsbnLookup, IsbnLookupError
+    table = IsbnLookup.__table__
+
+    def set_status(status):
+        """Return the statement setting the status of an isbn."""
+        return table.update().\
+            where(table.c.isbn == bindparam('b_isbn')).\
+            values(status=status, last_check=func.current_timestamp())
+
+    with engine.begin() as connection:
+        if succeeded:
+            connection.execute(set_status('SUCCESS_DIRECT'),
+                               [{'b_isbn': isbn} for isbn in succeeded])
+        if failed:
+            connection.execute(set_status('FAILED_DIRECT'),
+                               [{'b_isbn': isbn} for isbn, _ in failed])
+            connection.execute(
+                IsbnLookupError.__table__.insert().
+                values(checked_at=func.current_timestamp()),
+                [{'isbn': isbn, 'message': error}
+                 for isbn, error in failed])
+
+
+def load_isbn(session, isbn):
+    """Look up `isbn` online and add the book it identifies.
+
+    Returns None if the book was added, otherwise the reason it was not.
+    """
+    from bpslibrary.models import Author, Category
+
+    # a book added by an interrupted job is not looked up again
+    if resolve_isbn(session, isbn):
+        return None
+
+    api_client = APIClient([isbn], None)
+    found_books = api_client.find_books(direct_search_only=True)
+
+    # to ensure only the right book is added, only search resulting
+    # yielding 1 result is accepted.
+    if len(found_books) != 1:
+        if api_client.errors:
+            return '; '.join(api_client.errors)
+        return "search results %d" % len(found_books)
+
+    # now we add the book.
+    book = found_books[0]
+
+    # defaults
+    book.is_available = True
+    book.current_location = BookLocation.LIBRARY.value
+
+    for i in range(len(book.authors)):
+        lookup_author = Author.query.filter(
+            Author.name == book.authors[i].name).first()
+        if lookup_author:
+            book.authors[i] = None
+            book.authors[i] = lookup_author
+
+    for i in range(len(book.categories)):
+        lookup_category = Category.query.filter(
+            Category.name == book.categories[i].name).first()
+        if lookup_category:
+            book.categories[i] = None
+            book.categories[i] = lookup_category
+
+    session.add(book)
+    session.commit()
+
+    if book.thumbnail_url:
+        thumbnail_service.queue(book.id, book.thumbnail_url)
+    return None
+
+
+class AutoloadJob():
+    """The bulk loading job, controlled through its state file.
+
+    :param state_path: (str)
+    The JSON file holding the progress and pause flag of the job.
+
+    :param batch_size: (int)
+    The number of ISBNs taken from `isbn_lookup` at a time.
+    """
+
+    def __init__(self, state_path, batch_size):
+        """Initialise an AutoloadJob."""
+        self.state_path = state_path
+        self.batch_size = batch_size
+        self._thread = None
+
+    def _read(self):
+        """Return the state, an empty dict if no job ever ran."""
+        try:
+            with open(self.state_path) as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _update(self, precondition=None, **changes):
+        """Apply `changes` to the state file and return the new state.
+
+        The file is replaced atomically under a lock, so the job thread
+        and the processes pausing or resuming it do not lose updates.
+
+        :param precondition: (callable)
+        Called with the current state under the lock; nothing is changed
+        and None is returned unless it holds.
+        """
+        with open(self.state_path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            state = self._read()
+            if precondition is not None and not precondition(state):
+                return None
+            state.update(changes, updated_at=time.time())
+            temp_path = self.state_path + '.tmp'
+            with open(temp_path, 'w') as state_file:
+                json.dump(state, state_file)
+            os.replace(temp_path, self.state_path)
+            return state
+
+    @staticmethod
+    def _is_live(state):
+        """Tell whether `state` is of a running or paused job."""
+        return state.get('state') in ('running', 'paused') and \
+            time.time() - state.get('updated_at', 0) < STALE_AFTER
+
+    def is_running(self):
+        """Tell whether a job is running or paused in any process."""
+        return self._is_live(self._read())
+
+    def start(self, limit=None):
+        """Start a job loading up to `limit` ISBNs, all if not set.
+
+        Returns False if a job is already running. The check and the
+        start are one update of the state file, so of several processes
+        starting a job at once only one does.
+        """
+        started = self._update(
+            lambda state: not self._is_live(state),
+            state='running', paused=False, limit=limit,
+            started_at=time.time(), run_seconds=0.0, done=0, succeeded=0,
+            failed=0, last_isbn=None, error=None, provider_latency={})
+        if started is None:
+            return False
+
+        self._thread = threading.Thread(target=self._run, args=(limit,),
+                                        name='autoload', daemon=True)
+        self._thread.start()
+        return True
+
+    def pause(self):
+        """Ask the running job to pause after the current ISBN."""
+        self._update(self._is_live, paused=True)
+
+    def resume(self):
+        """Let a paused job carry on."""
+        self._update(self._is_live, paused=False)
+
+    def status(self):
+        """Return the progress and throughput of the last job."""
+        state = self._read()
+        if not state:
+            return {'state': 'idle'}
+
+        if state['state'] in ('running', 'paused') and not self.is_running():
+            state['state'] = 'interrupted'
+        minutes = state['run_seconds'] / 60
+        state['isbns_per_minute'] = \
+            round(state['done'] / minutes, 1) if minutes else 0.0
+        return state
+
+    def _wait_while_paused(self, checkpoint):
+        """Block while the job is paused, keeping its heartbeat alive.
+
+        `checkpoint` is called before pausing, so the status of the ISBNs
+        done so far is written.
+        """
+        if not self._read().get('paused'):
+            return
+        checkpoint()
+        while self._read().get('paused'):
+            self._update(state='paused')
+            time.sleep(PAUSE_POLL)
+        self._update(state='running')
+
+    def _run(self, limit):
+        """Load batches of ISBNs until none are left or `limit` is hit."""
+        from bpslibrary.database import db_session
+
+        job_started = check_time()
+        succeeded, failed = [], []
+        counts = {'done': 0, 'succeeded': 0, 'failed': 0}
+        run_seconds = 0.0
+
+        def checkpoint():
+            """Write the status of the ISBNs done since the last call."""
+            record_results(succeeded, failed)
+            del succeeded[:], failed[:]
+
+        try:
+            while limit is None or counts['done'] < limit:
+                batch_size = self.batch_size if limit is None \
+                    else min(self.batch_size, limit - counts['done'])
+                # the status of the isbns done is written before the next
+                # batch, so each batch only holds isbns not tried yet
+                isbns = fetch_isbns(batch_size, job_started)
+                if not isbns:
+                    break
+
+                APIClient(None, None).search_google_books_batch(isbns)
+
+                for isbn in isbns:
+                    self._wait_while_paused(checkpoint)
+                    started = time.time()
+
+                    try:
+                        error = load_isbn(db_session(), isbn)
+                    except Exception as err:  # pylint: disable=W0703
+                        db_session.rollback()
+                        error = str(err)
+
+                    if error is None:
+                        succeeded.append(isbn)
+                        counts['succeeded'] += 1
+                    else:
+                        failed.append((isbn, error))
+                        counts['failed'] += 1
+
+                    counts['done'] += 1
+                    run_seconds += time.time() - started
+                    self._update(last_isbn=isbn,
+                                 run_seconds=run_seconds,
+                                 provider_latency=provider_latency(),
+                                 **counts)
+
+                checkpoint()
+
+            self._update(state='finished', paused=False)
+        except Exception as err:  # pylint: disable=W0703
+            self._update(state='failed', paused=False, error=str(err))
+        finally:
+            db_session.remove()
+
+
+# pylint: disable=C0103
+autoload_job = AutoloadJob(app.config['AUTOLOAD_STATE_PATH'],
+                           app.config['AUTOLOAD_BATCH_SIZE'])
@@ -1,61 +1,155 @@
 """
 Barcode
 =======
+
+Extraction of ISBNs from photos of book barcodes.
+
+Images are decoded straight to greyscale, at a reduced scale where the
+format allows, and shrunk (keeping their aspect ratio) only when larger
+than `MAX_LENGTH`. The image is scanned as it is first; the contrast
+enhanced and rescaled passes only run while no ISBN has been found.
+Scanners are reused from a pool, and the time spent in every stage is
+recorded.
 """
 
+import queue
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
 import zbar
 import zbar.misc
 import numpy as np
 from PIL import Image, ImageEnhance
 
 
-def scan_for_isbn(image_file):
-    """A method to extract the ISBN from an image of the barcode.
+SCANNER_CONFIG = [('ZBAR_ISBN13', 'ZBAR_CFG_ENABLE', 1)]
+
+# the longest side in pixels images are scanned at
+MAX_LENGTH = 850
+
+# the scale of the last pass, for barcodes too wide or narrow for zbar
+RESCALE_FACTOR = 0.6
 
-    :param image_file:
-        A filename (string), pathlib.Path object or a file object.
-        The file object must implement :py:meth:`~file.read`,
-        :py:meth:`~file.seek`, and :py:meth:`~file.tell` methods,
-        and be opened in binary mode.
-    """
-    isbns = []
 
-    max_length = 850
-    scanner = zbar.Scanner(config=[('ZBAR_ISBN13', 'ZBAR_CFG_ENABLE', 1)])
+class ScannerPool():
+    """A pool of reusable zbar scanners, one per concurrent scan."""
 
-    # import image, converting to black and white
-    image = Image.open(image_file).convert('L')
+    def __init__(self):
+        """Initialise an empty ScannerPool."""
+        self._scanners = queue.LifoQueue()
 
-    # resize big images for speed and improved scanning in most cases
-    if [d > max_length for d in image.size]:
-        image = image.resize((500, 700), Image.ANTIALIAS)
+    @contextmanager
+    def scanner(self):
+        """Lend a scanner, creating one if none is free."""
+        try:
+            scanner = self._scanners.get_nowait()
+        except queue.Empty:
+            scanner = zbar.Scanner(config=SCANNER_CONFIG)
+        try:
+            yield scanner
+        finally:
+            self._scanners.put(scanner)
 
-    # first scan image as it is
-    img_arr = np.fromstring(image.tobytes(), dtype=np.uint8)
-    img_arr = img_arr.reshape((image.size[1], image.size[0]))
 
-    results = scanner.scan(img_arr)
+class StageTimings():
+    """The number of runs and total seconds of every scanning stage."""
 
-    # if no ISBN or non-ISBN code found, enhance contrast and scan again
-    if not results or not all(r.type == 'ISBN-13' for r in results):
-        image = ImageEnhance.Contrast(image).enhance(2)
+    def __init__(self):
+        """Initialise empty StageTimings."""
+        self._lock = threading.Lock()
+        self._runs = Counter()
+        self._seconds = Counter()
 
-        img_arr = np.fromstring(image.tobytes(), dtype=np.uint8)
-        img_arr = img_arr.reshape((image.size[1], image.size[0]))
+    def add(self, timings):
+        """Add the `{stage: seconds}` timings of a scan."""
+        with self._lock:
+            self._runs.update(timings.keys())
+            self._seconds.update(timings)
 
-        results = scanner.scan(img_arr)
+    def summary(self):
+        """Return the runs and mean milliseconds of every stage."""
+        with self._lock:
+            return {stage: {'runs': runs,
+                            'mean_ms': round(
+                                1000 * self._seconds[stage] / runs, 1)}
+                    for stage, runs in self._runs.items()}
 
-    # if no ISBN or non-ISBN codes found, change size and scan again
-    if not results or not all(r.type == 'ISBN-13' for r in results):
-        image = image.resize((700, 500), Image.ANTIALIAS)
 
-        img_arr = np.fromstring(image.tobytes(), dtype=np.uint8)
-        img_arr = img_arr.reshape((image.size[1], image.size[0]))
+# pylint: disable=C0103
+scanner_pool = ScannerPool()
+stage_timings = StageTimings()
 
-        results = scanner.scan(img_arr)
 
-    if results:
-        for result in [r for r in results if r.type == 'ISBN-13']:
-            isbns.append(result.data.decode('ascii'))
+def find_isbns(scanner, image):
+    """Scan a greyscale image, returning the ISBN-13 codes found."""
+    return [r.data.decode('ascii') for r in scanner.scan(np.asarray(image))
+            if r.type == 'ISBN-13']
 
-    return isbns
+
+def scan_for_isbn(image_file, timings=None, max_length=MAX_LENGTH):
+    """A method to extract the ISBN from an image of the barcode.
+
+    :param image_file:
+        A filename (string), pathlib.Path object or a file object.
+        The file object must implement :py:meth:`~file.read`,
+        :py:meth:`~file.seek`, and :py:meth:`~file.tell` methods,
+        and be opened in binary mode.
+
+    :param timings: (dict)
+        If given, filled with the seconds spent in every stage run.
+
+    :param max_length: (int)
+        The longest side in pixels the image is scanned at; photos of
+        several barcodes need more than the default.
+    """
+    timings = {} if timings is None else timings
+
+    @contextmanager
+    def stage(name):
+        """Time the stage `name`."""
+        started = time.perf_counter()
+        yield
+        timings[name] = time.perf_counter() - started
+
+    try:
+        # import image, converting to black and white; jpeg images are
+        # decoded at the smallest scale still larger than max_length
+        with stage('decode'):
+            image = Image.open(image_file)
+            ratio = max_length / max(image.size)
+            if ratio < 1:
+                image.draft('L', (int(image.width * ratio) + 1,
+                                  int(image.height * ratio) + 1))
+            image = image.convert('L')
+
+        # shrink big images for speed and improved scanning in most cases
+        if max(image.size) > max_length:
+            with stage('resize'):
+                image.thumbnail((max_length, max_length), Image.LANCZOS)
+
+        with scanner_pool.scanner() as scanner:
+            # first scan image as it is
+            with stage('scan'):
+                isbns = find_isbns(scanner, image)
+            if isbns:
+                return isbns
+
+            # if no ISBN found, enhance contrast and scan again
+            with stage('enhance'):
+                image = ImageEnhance.Contrast(image).enhance(2)
+            with stage('scan_enhanced'):
+                isbns = find_isbns(scanner, image)
+            if isbns:
+                return isbns
+
+            # if still no ISBN found, change size and scan again
+            with stage('rescale'):
+                image = image.resize(
+                    (max(1, round(image.width * RESCALE_FACTOR)),
+                     max(1, round(image.height * RESCALE_FACTOR))),
+                    Image.LANCZOS)
+            with stage('scan_rescaled'):
+                return find_isbns(scanner, image)
+    finally:
+        stage_timings.add(timings)
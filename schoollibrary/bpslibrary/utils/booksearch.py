@@ -0,0 +1,294 @@
+"""
+Book search
+===========
+
+Search backends for finding books by title, description, author names
+and category names.
+
+On SQLite engines with FTS5 support, an FTS5 virtual table (`books_fts`)
+mirrors the searchable text of every book and is kept in sync with the
+ORM models on each flush. Results are ranked with bm25 and the page and
+the total count are served by a single query. On other engines, or when
+FTS5 is not compiled in, searching falls back to `LIKE` matching.
+"""
+
+import re
+from sqlalchemy import bindparam, event, exc, or_, text
+from sqlalchemy.orm import Session
+from bpslibrary.utils.pagination import listing_cache
+
+
+# bm25 weights of the title, description, authors and categories columns
+FTS_WEIGHTS = (10.0, 1.0, 5.0, 3.0)
+
+CREATE_FTS_SQL = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS books_fts
+    USING fts5(title, description, authors, categories,
+               tokenize = 'unicode61');
+    """
+
+INDEX_BOOKS_SQL = """
+    INSERT INTO books_fts (rowid, title, description, authors, categories)
+    SELECT
+        b.id,
+        b.title,
+        b.description,
+        (SELECT group_concat(a.name, ' ')
+         FROM authors a JOIN book_author ba ON ba.author_id = a.id
+         WHERE ba.book_id = b.id),
+        (SELECT group_concat(c.name, ' ')
+         FROM categories c JOIN book_category bc ON bc.category_id = c.id
+         WHERE bc.book_id = b.id)
+    FROM books b
+    """
+
+SEARCH_SQL = """
+    SELECT book_id, count(*) OVER () AS total
+    FROM (SELECT rowid AS book_id, bm25(books_fts, {}, {}, {}, {}) AS score
+          FROM books_fts
+          WHERE books_fts MATCH :query)
+    ORDER BY score, book_id
+    LIMIT :limit OFFSET :offset;
+    """.format(*FTS_WEIGHTS)
+
+COUNT_SQL = """
+    SELECT count(*) FROM books_fts WHERE books_fts MATCH :query;
+    """
+
+
+class LikeSearch():
+    """Search books with `LIKE` over titles, author and category names."""
+
+    name = 'like'
+
+    def search(self, session, search_term, page, per_page, options=()):
+        """Return the total number of matches and the requested page.
+
+        :param session: (Session)
+        The session to query.
+
+        :param search_term: (str)
+        A full or partial book title, author name or category name.
+
+        :param page: (int)
+        The 1-based page number.
+
+        :param per_page: (int)
+        The number of books per page.
+
+        :param options: (tuple)
+        Loader options applied to the books query.
+        """
+        from bpslibrary.models import Author, Book, Category
+
+        search_term = '%' + search_term.strip() + '%'
+        query = session.query(Book).\
+            join(Author.books).\
+            filter(or_(Book.title.ilike(search_term),
+                       Author.name.ilike(search_term))).\
+            union(
+                session.query(Book).
+                join(Category.books).
+                filter(or_(Book.title.ilike(search_term),
+                           Category.name.ilike(search_term)))
+            )
+
+        total = listing_cache.total(('search', search_term.lower()),
+                                    query.count)
+        books = query.options(*options).order_by(Book.title).\
+            limit(per_page).offset((page - 1) * per_page).all()
+        return total, books
+
+
+class FTSSearch():
+    """Search books through the SQLite FTS5 `books_fts` table."""
+
+    name = 'fts5'
+
+    def search(self, session, search_term, page, per_page, options=()):
+        """Return the total number of matches and the requested page.
+
+        Books are ordered by bm25 relevance, title matches weighing the
+        most. Every word of `search_term` must prefix a word of the book.
+
+        :param session: (Session)
+        The session to query.
+
+        :param search_term: (str)
+        Words from a book title, description, author or category name.
+
+        :param page: (int)
+        The 1-based page number.
+
+        :param per_page: (int)
+        The number of books per page.
+
+        :param options: (tuple)
+        Loader options applied to the books query.
+        """
+        from bpslibrary.models import Book
+
+        query = match_query(search_term)
+        if not query:
+            return 0, []
+
+        rows = session.execute(text(SEARCH_SQL),
+                               {'query': query,
+                                'limit': per_page,
+                                'offset': (page - 1) * per_page}).fetchall()
+
+        if not rows:
+            # past the last page, the window count is not available
+            total = session.execute(text(COUNT_SQL),
+                                    {'query': query}).scalar()
+            return total, []
+
+        total = rows[0][1]
+        ids = [row[0] for row in rows]
+        books = {b.id: b for b in
+                 session.query(Book).options(*options).
+                 filter(Book.id.in_(ids))}
+        return total, [books[i] for i in ids if i in books]
+
+
+def match_query(search_term):
+    """Build an FTS5 query matching every word of `search_term` as prefix.
+
+    :param search_term: (str)
+    The text typed in the search box.
+    """
+    words = re.findall(r'\w+', search_term or '')
+    return ' '.join('"%s"*' % w for w in words)
+
+
+# pylint: disable=C0103
+backend = LikeSearch()
+
+
+def search_books(session, search_term, page, per_page, options=()):
+    """Search books using the backend selected for the database engine.
+
+    See :meth:`LikeSearch.search` for the parameters.
+    """
+    return backend.search(session, search_term, page, per_page, options)
+
+
+def index_books(connection, book_ids=None):
+    """(Re)index the given books, or all books if `book_ids` is None.
+
+    :param connection: (Connection)
+    The connection to write to, within the current transaction.
+
+    :param book_ids: (iterable)
+    The ids of the books to reindex.
+    """
+    if book_ids is None:
+        connection.execute(text('DELETE FROM books_fts;'))
+        connection.execute(text(INDEX_BOOKS_SQL))
+        return
+
+    params = {'ids': list(book_ids)}
+    if not params['ids']:
+        return
+    connection.execute(
+        text('DELETE FROM books_fts WHERE rowid IN :ids;').
+        bindparams(bindparam('ids', expanding=True)), params)
+    connection.execute(
+        text(INDEX_BOOKS_SQL + ' WHERE b.id IN :ids').
+        bindparams(bindparam('ids', expanding=True)), params)
+
+
+def _linked_book_ids(connection, table, column, ids):
+    """Ids of the books linked to `ids` through association `table`."""
+    if not ids:
+        return set()
+    sql = text('SELECT book_id FROM %s WHERE %s IN :ids' % (table, column)).\
+        bindparams(bindparam('ids', expanding=True))
+    return {row[0] for row in connection.execute(sql, {'ids': list(ids)})}
+
+
+_UNLINKED_KEY = 'book_search_unlinked_books'
+
+
+def _before_flush(session, flush_context, instances):
+    """Note the books of the authors and categories about to be deleted.
+
+    Their association rows are gone by the time the flush is done.
+    """
+    from bpslibrary.models import Author, Category
+
+    author_ids = {obj.id for obj in session.deleted
+                  if isinstance(obj, Author)}
+    category_ids = {obj.id for obj in session.deleted
+                    if isinstance(obj, Category)}
+    if not (author_ids or category_ids):
+        return
+
+    connection = session.connection()
+    unlinked = session.info.setdefault(_UNLINKED_KEY, set())
+    unlinked |= _linked_book_ids(connection, 'book_author',
+                                 'author_id', author_ids)
+    unlinked |= _linked_book_ids(connection, 'book_category',
+                                 'category_id', category_ids)
+
+
+def _after_flush(session, flush_context):
+    """Reindex the books touched by the flush in the same transaction."""
+    from bpslibrary.models import Author, Book, Category
+
+    book_ids = session.info.pop(_UNLINKED_KEY, set())
+    author_ids = set()
+    category_ids = set()
+
+    for obj in list(session.new) + list(session.dirty) + \
+            list(session.deleted):
+        if isinstance(obj, Book):
+            book_ids.add(obj.id)
+        elif isinstance(obj, Author) and obj not in session.new:
+            author_ids.add(obj.id)
+        elif isinstance(obj, Category) and obj not in session.new:
+            category_ids.add(obj.id)
+
+    if not (book_ids or author_ids or category_ids):
+        return
+
+    connection = session.connection()
+    book_ids |= _linked_book_ids(connection, 'book_author',
+                                 'author_id', author_ids)
+    book_ids |= _linked_book_ids(connection, 'book_category',
+                                 'category_id', category_ids)
+    book_ids.discard(None)
+    index_books(connection, book_ids)
+
+
+def init_book_search(session):
+    """Select the search backend and prepare the full-text index.
+
+    :param session: (Session)
+    The session used to create and populate the index.
+    """
+    # pylint: disable=W0603
+    global backend
+
+    if session.get_bind().dialect.name != 'sqlite':
+        backend = LikeSearch()
+        return
+
+    try:
+        session.execute(text(CREATE_FTS_SQL))
+    except exc.OperationalError:
+        # FTS5 is not available in this SQLite build
+        session.rollback()
+        backend = LikeSearch()
+        return
+
+    indexed = session.execute(text('SELECT count(*) FROM books_fts;')).scalar()
+    books = session.execute(text('SELECT count(*) FROM books;')).scalar()
+    if indexed != books:
+        index_books(session.connection())
+    session.commit()
+
+    if not event.contains(Session, 'after_flush', _after_flush):
+        event.listen(Session, 'before_flush', _before_flush)
+        event.listen(Session, 'after_flush', _after_flush)
+    backend = FTSSearch()
@@ -0,0 +1,254 @@
+"""
+Decoding
+========
+
+Barcode decoding of uploaded photos on a pool of worker processes.
+
+Decoding a phone photo is CPU bound, so it runs outside the web worker.
+At most `BARCODE_QUEUE_SIZE` photos are queued or decoding at a time;
+past that, uploads are turned away with :class:`DecoderBusy` straight
+away rather than piling up behind each other. Every photo has a deadline
+of `BARCODE_DEADLINE` seconds. Photos uploaded together are queued as
+earlier ones finish, waiting for the queue up to a deadline scaled to the
+number of photos. The queue depth and the decode latency are kept as
+metrics.
+
+The processes are forked from a fork server rather than from the threaded
+web worker, which may hold locks at the time; they import the package
+without setting up the application. A pool broken by a dead process is
+dropped and started again on the next photo.
+"""
+
+import io
+import math
+import multiprocessing
+import threading
+import time
+from collections import deque
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from bpslibrary import app
+from bpslibrary.utils.barcode import MAX_LENGTH, scan_for_isbn, stage_timings
+
+
+# number of recent decodes the latency percentiles are computed over
+LATENCY_WINDOW = 200
+
+# how decoding processes are started
+START_METHOD = 'forkserver'
+
+
+class DecoderBusy(ValueError):
+    """Raised when the decoding queue is full."""
+
+
+def decode(data, max_length=MAX_LENGTH):
+    """Scan the image `data`, returning the ISBNs and stage timings."""
+    timings = {}
+    return scan_for_isbn(io.BytesIO(data), timings, max_length), timings
+
+
+class DecodingService():
+    """A bounded pool of barcode decoding processes.
+
+    :param max_workers: (int)
+    The number of decoding processes.
+
+    :param queue_size: (int)
+    The most photos queued or decoding at a time.
+
+    :param deadline: (float)
+    Seconds a photo may take to decode, queueing included.
+    """
+
+    def __init__(self, max_workers, queue_size, deadline):
+        """Initialise a DecodingService."""
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.deadline = deadline
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._depth = 0
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._counts = {'decoded': 0, 'rejected': 0, 'timed_out': 0,
+                        'failed': 0, 'restarts': 0}
+
+    def _get_executor(self):
+        """Return the process pool, starting it on first use."""
+        with self._lock:
+            if self._executor is None:
+                context = multiprocessing.get_context(START_METHOD)
+                if START_METHOD == 'forkserver':
+                    # the server is not a child process, so it would set
+                    # up the application if it imported the main module
+                    context.set_forkserver_preload([])
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=context)
+            return self._executor
+
+    def _discard(self, executor):
+        """Drop the broken pool `executor`, so the next photo starts one.
+        """
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+            self._counts['restarts'] += 1
+        app.logger.warning("barcode decoding pool broken, restarting it")
+        executor.shutdown(wait=False)
+
+    def _count(self, name):
+        """Increment the counter `name`."""
+        with self._lock:
+            self._counts[name] += 1
+
+    def _release(self, executor, future):
+        """Free the queue slot of a finished decode."""
+        with self._lock:
+            self._depth -= 1
+        self._slots.release()
+        if not future.cancelled() and \
+           isinstance(future.exception(), BrokenProcessPool):
+            self._discard(executor)
+
+    def submit(self, image_file, max_length=MAX_LENGTH, wait_until=None):
+        """Queue the photo `image_file` for decoding.
+
+        Returns a `(future, started)` pair for :meth:`result`. Raises
+        :class:`DecoderBusy` if the queue is full.
+
+        :param wait_until: (float)
+        The time until which to wait for room in the queue; the queue
+        must have room straight away if not set.
+        """
+        if wait_until is None:
+            acquired = self._slots.acquire(blocking=False)
+        else:
+            acquired = self._slots.acquire(
+                timeout=max(0, wait_until - time.time()))
+        if not acquired:
+            self._count('rejected')
+            raise DecoderBusy(
+                "The barcode reader is busy, please retry in a few seconds.")
+
+        started = time.time()
+        try:
+            data = image_file.read()
+            executor = self._get_executor()
+            try:
+                future = executor.submit(decode, data, max_length)
+            except BrokenProcessPool:
+                self._discard(executor)
+                executor = self._get_executor()
+                future = executor.submit(decode, data, max_length)
+        except BrokenProcessPool:
+            self._slots.release()
+            raise ValueError("The barcode reader is restarting, please "
+                             "retry in a few seconds.")
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._depth += 1
+        # the slot is held until the process is done, even past the
+        # deadline, so stuck decodes keep counting against the queue
+        future.add_done_callback(partial(self._release, executor))
+        return future, started
+
+    def result(self, future, started):
+        """Return the ISBNs of a photo queued by :meth:`submit`.
+
+        Raises ValueError if the photo could not be decoded in time.
+        """
+        try:
+            isbns, timings = future.result(
+                timeout=max(0, started + self.deadline - time.time()))
+        except TimeoutError:
+            future.cancel()
+            self._count('timed_out')
+            raise ValueError("Reading the barcode took too long, please "
+                             "retry with a closer photo.")
+        except BrokenProcessPool:
+            # the pool is dropped by the done callback
+            raise ValueError("The barcode reader stopped unexpectedly, "
+                             "please retry.")
+        except Exception:
+            self._count('failed')
+            raise ValueError("The barcode image could not be read.")
+
+        stage_timings.add(timings)
+        with self._lock:
+            self._counts['decoded'] += 1
+            self._latencies.append(time.time() - started)
+        return isbns
+
+    def scan_for_isbn(self, image_file):
+        """Return the ISBNs in the photo `image_file`.
+
+        Raises :class:`DecoderBusy` if the queue is full, and ValueError
+        if the photo could not be decoded in time.
+        """
+        return self.result(*self.submit(image_file))
+
+    def scan_many(self, image_files, max_length=MAX_LENGTH):
+        """Decode several photos in parallel.
+
+        At most `max_workers` photos are queued at a time, the next one
+        as soon as the first of them is done, so the deadline of a photo
+        runs from about when its decode starts. Photos still waiting for
+        room in the queue once every `max_workers` photos had their
+        deadline are turned away as busy.
+
+        Returns a list of `(isbns, error)` pairs, in the order of
+        `image_files`; `error` is the message of a photo not decoded.
+        """
+        wait_until = time.time() + self.deadline * math.ceil(
+            len(image_files) / self.max_workers)
+        results = [None] * len(image_files)
+        queued = deque()
+
+        def collect():
+            """Wait for the result of the oldest queued photo."""
+            index, submitted = queued.popleft()
+            try:
+                results[index] = (self.result(*submitted), None)
+            except ValueError as err:
+                results[index] = ([], str(err))
+
+        for index, image_file in enumerate(image_files):
+            if len(queued) >= self.max_workers:
+                collect()
+            try:
+                queued.append((index, self.submit(image_file, max_length,
+                                                  wait_until)))
+            except ValueError as err:
+                results[index] = ([], str(err))
+        while queued:
+            collect()
+        return results
+
+    def metrics(self):
+        """Return the queue depth, counters and decode latency (ms)."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            metrics = dict(self._counts,
+                           queue_depth=self._depth,
+                           queue_size=self.queue_size,
+                           workers=self.max_workers)
+        if latencies:
+            metrics['latency_ms'] = {
+                'mean': round(1000 * sum(latencies) / len(latencies), 1),
+                'p50': round(1000 * latencies[len(latencies) // 2], 1),
+                'p95': round(1000 * latencies[
+                    min(len(latencies) - 1, int(len(latencies) * 0.95))], 1),
+            }
+        return metrics
+
+
+# pylint: disable=C0103
+decoding_service = DecodingService(app.config['BARCODE_WORKERS'],
+                                   app.config['BARCODE_QUEUE_SIZE'],
+                                   app.config['BARCODE_DEADLINE'])
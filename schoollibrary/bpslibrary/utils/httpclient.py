@@ -0,0 +1,137 @@
+"""
+HTTP client
+===========
+
+Shared, pooled HTTP sessions for the online book information providers.
+
+Each provider host gets one `requests.Session` for the whole process, so
+lookups reuse kept-alive connections instead of paying a new TCP and TLS
+handshake per call. Connections per host are capped (callers wait for a
+free connection), idempotent requests are retried with exponential
+backoff on connection errors and throttling or server errors, and every
+request has a connect and read timeout. Calls wait for a token of the
+host's rate limiter (see :mod:`bpslibrary.utils.ratelimit`), for at most
+`max_wait` seconds if given.
+"""
+
+import threading
+import time
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bpslibrary import app
+from bpslibrary.utils.ratelimit import rate_limiter
+
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_slots = {}
+_latency = {}
+
+
+def provider_setting(host, name):
+    """Return setting `name` of `host`, falling back to the default.
+
+    :param host: (str)
+    The provider host name, e.g. `www.googleapis.com`.
+
+    :param name: (str)
+    One of `timeout`, `retries`, `backoff_factor`, `max_connections`,
+    `rate` or `burst`.
+    """
+    overrides = app.config['HTTP_PROVIDER_SETTINGS'].get(host, {})
+    if name in overrides:
+        return overrides[name]
+    return {
+        'timeout': app.config['HTTP_TIMEOUT'],
+        'retries': app.config['HTTP_RETRIES'],
+        'backoff_factor': app.config['HTTP_BACKOFF_FACTOR'],
+        'max_connections': app.config['HTTP_MAX_CONNECTIONS_PER_HOST'],
+        'rate': app.config['HTTP_RATE_LIMIT'],
+        'burst': app.config['HTTP_RATE_BURST'],
+    }[name]
+
+
+def get_session(host):
+    """Return the shared session of `host`, creating it on first use."""
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            retry = Retry(total=provider_setting(host, 'retries'),
+                          backoff_factor=provider_setting(
+                              host, 'backoff_factor'),
+                          status_forcelist=RETRY_STATUSES,
+                          raise_on_status=False)
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=provider_setting(host, 'max_connections'),
+                pool_block=True,
+                max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[host] = session
+        return session
+
+
+def provider_slot(host):
+    """Return the semaphore capping concurrent calls to `host`.
+
+    Use it as a context manager around calls that do not go through
+    :func:`http_get`, e.g. provider SDKs with their own HTTP stack.
+    """
+    with _sessions_lock:
+        slot = _slots.get(host)
+        if slot is None:
+            slot = threading.BoundedSemaphore(
+                provider_setting(host, 'max_connections'))
+            _slots[host] = slot
+        return slot
+
+
+def throttle(host, max_wait=None):
+    """Wait until the rate limit of `host` allows another call.
+
+    Raises :class:`~bpslibrary.utils.ratelimit.RateLimitExceeded` if that
+    is more than `max_wait` seconds away.
+    """
+    rate_limiter.acquire(host,
+                         provider_setting(host, 'rate'),
+                         provider_setting(host, 'burst'),
+                         max_wait)
+
+
+def record_latency(host, seconds):
+    """Add a call of `seconds` to the latency statistics of `host`."""
+    with _sessions_lock:
+        calls, total = _latency.get(host, (0, 0.0))
+        _latency[host] = (calls + 1, total + seconds)
+
+
+def provider_latency():
+    """Return the number of calls and mean latency (ms) of every host."""
+    with _sessions_lock:
+        return {host: {'calls': calls,
+                       'mean_ms': round(1000 * total / calls, 1)}
+                for host, (calls, total) in _latency.items()}
+
+
+def http_get(url, max_wait=None, **kwargs):
+    """GET `url` through the shared session of its host.
+
+    The host's timeout applies unless `timeout` is passed; other keyword
+    arguments are passed on to :meth:`requests.Session.get`. See
+    :func:`throttle` for `max_wait`.
+    """
+    host = urlparse(url).hostname
+    kwargs.setdefault('timeout', provider_setting(host, 'timeout'))
+    throttle(host, max_wait)
+    with provider_slot(host):
+        started = time.time()
+        try:
+            return get_session(host).get(url, **kwargs)
+        finally:
+            record_latency(host, time.time() - started)
@@ -0,0 +1,121 @@
+"""
+Identity
+========
+
+A per-process cache of the logged in users, their classrooms and the
+pupil choices of the loan forms.
+
+Every authenticated request needs the user, its classroom and, on the
+pages with a loan form, the names of the classroom's pupils. These change
+rarely, so they are read once and kept as plain values for
+`IDENTITY_CACHE_TTL` seconds, rather than loaded again on every request.
+The views that change users, classrooms or pupils clear the cache of
+their process; other processes see the change once their copy expires.
+"""
+
+import threading
+import time
+from collections import Counter, namedtuple
+from flask_login import UserMixin
+from bpslibrary import app
+
+
+CachedClassroom = namedtuple('CachedClassroom', 'id name year')
+
+
+class CachedUser(UserMixin):
+    """A logged in user, detached from any database session.
+
+    :param pupil_choices: (tuple)
+    The `(id, name)` of the pupils of the user's classroom.
+    """
+
+    def __init__(self, user_id, username, is_admin, classroom=None,
+                 pupil_choices=()):
+        """Initialise a CachedUser."""
+        self.id = user_id  # pylint: disable=C0103
+        self.username = username
+        self.is_admin = is_admin
+        self.classroom = classroom
+        self.pupil_choices = pupil_choices
+
+    def get_id(self):
+        """Retrieve the user by id."""
+        return str(self.id)
+
+    def __repr__(self):
+        """CachedUser representation."""
+        return "<CachedUser %r>" % self.username
+
+
+class IdentityCache():
+    """Users by id, kept for `ttl` seconds.
+
+    :param ttl: (float)
+    Seconds a user is kept; 0 disables the cache.
+    """
+
+    def __init__(self, ttl):
+        """Initialise an empty IdentityCache."""
+        self.ttl = ttl
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._users = {}
+        self._generation = 0
+
+    def get(self, session, user_id):
+        """Return the user `user_id`, or None if there is no such user.
+
+        :param session: (Session)
+        The session to load the user with if it is not cached.
+
+        :param user_id: (int)
+        The id of the user.
+        """
+        with self._lock:
+            cached = self._users.get(user_id)
+            generation = self._generation
+        if cached is not None and cached[0] > time.time():
+            self.stats['hits'] += 1
+            return cached[1]
+
+        self.stats['misses'] += 1
+        user = self._load(session, user_id)
+        if user is not None and self.ttl:
+            with self._lock:
+                # not kept if the cache was cleared while loading
+                if generation == self._generation:
+                    self._users[user_id] = (time.time() + self.ttl, user)
+        return user
+
+    @staticmethod
+    def _load(session, user_id):
+        """Read a user, its classroom and its pupils."""
+        from bpslibrary.models import Classroom, Pupil, User
+
+        row = session.query(User.id, User.username, User.is_admin,
+                            Classroom.id, Classroom.name, Classroom.year).\
+            outerjoin(Classroom, Classroom.user_id == User.id).\
+            filter(User.id == user_id).first()
+        if row is None:
+            return None
+
+        classroom = None
+        pupil_choices = ()
+        if row[3] is not None:
+            classroom = CachedClassroom(row[3], row[4], row[5])
+            pupil_choices = tuple(
+                (p[0], p[1]) for p in session.query(Pupil.id, Pupil.name).
+                filter(Pupil.classroom_id == classroom.id))
+        return CachedUser(row[0], row[1], row[2], classroom, pupil_choices)
+
+    def clear(self):
+        """Forget all users, after a change of users or classrooms."""
+        with self._lock:
+            self._users.clear()
+            self._generation += 1
+        self.stats['clears'] += 1
+
+
+# pylint: disable=C0103
+identity_cache = IdentityCache(app.config['IDENTITY_CACHE_TTL'])
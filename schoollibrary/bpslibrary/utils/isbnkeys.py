@@ -0,0 +1,196 @@
+"""
+ISBN keys
+=========
+
+A normalised index of the ISBNs of books.
+
+Books keep their ISBN-10 and ISBN-13 in separate, free text columns.
+Every valid ISBN of a book is also stored in `book_isbns` as an ISBN-13
+without separators, uniquely keyed: the book's own ISBN-13 as its
+canonical key, and its ISBN-10 and any other known ISBNs of the same
+book as aliases. Any ISBN, scanned or typed, in either form and with or
+without hyphens, then resolves to its book with one indexed lookup.
+
+The keys of a book are rewritten whenever its ISBN columns change.
+"""
+
+import re
+import pyisbn
+from sqlalchemy import event, inspect
+
+
+CANONICAL = 'canonical'
+ISBN10 = 'isbn10'
+ALIAS = 'alias'
+
+
+def normalise_isbn(isbn):
+    """Return `isbn` as an ISBN-13 without separators.
+
+    Returns None if `isbn` is not a valid ISBN-10 or ISBN-13.
+    """
+    if not isbn:
+        return None
+    isbn = re.sub(r'[^0-9X]', '', isbn.upper())
+    if len(isbn) not in (10, 13):
+        return None
+    try:
+        if not pyisbn.validate(isbn):
+            return None
+        return pyisbn.convert(isbn) if len(isbn) == 10 else isbn
+    except ValueError:
+        return None
+
+
+def book_keys(isbn13, isbn10):
+    """Return the `{key: kind}` of the ISBN columns of a book."""
+    keys = {}
+    for isbn, kind in ((isbn10, ISBN10), (isbn13, CANONICAL)):
+        key = normalise_isbn(isbn)
+        if key:
+            keys[key] = kind
+    return keys
+
+
+def write_keys(connection, book_id, isbn13, isbn10):
+    """Replace the keys derived from the ISBN columns of a book.
+
+    Aliases are kept. Keys already held by another book are skipped.
+    """
+    from bpslibrary.models import BookIsbn
+    table = BookIsbn.__table__
+
+    connection.execute(table.delete().
+                       where(table.c.book_id == book_id).
+                       where(table.c.kind.in_([CANONICAL, ISBN10])))
+
+    keys = book_keys(isbn13, isbn10)
+    if not keys:
+        return
+    taken = {row[0] for row in connection.execute(
+        table.select().with_only_columns([table.c.isbn]).
+        where(table.c.isbn.in_(list(keys))))}
+    rows = [{'isbn': key, 'book_id': book_id, 'kind': kind}
+            for key, kind in keys.items() if key not in taken]
+    if rows:
+        connection.execute(table.insert(), rows)
+
+
+def sync_isbn_keys(connection):
+    """Rebuild the keys of all books."""
+    from bpslibrary.models import Book, BookIsbn
+    books = Book.__table__
+    table = BookIsbn.__table__
+
+    connection.execute(table.delete().
+                       where(table.c.kind.in_([CANONICAL, ISBN10])))
+    taken = {row[0] for row in connection.execute(
+        table.select().with_only_columns([table.c.isbn]))}
+
+    rows = []
+    for book_id, isbn13, isbn10 in connection.execute(
+            books.select().with_only_columns(
+                [books.c.id, books.c.isbn13, books.c.isbn10]).
+            order_by(books.c.id)):
+        for key, kind in book_keys(isbn13, isbn10).items():
+            if key not in taken:
+                taken.add(key)
+                rows.append({'isbn': key, 'book_id': book_id, 'kind': kind})
+    if rows:
+        connection.execute(table.insert(), rows)
+
+
+def add_alias(session, book, isbn):
+    """Make `isbn` resolve to `book` too.
+
+    Raises ValueError if `isbn` is not valid or is a key of another book.
+    """
+    from bpslibrary.models import BookIsbn
+
+    key = normalise_isbn(isbn)
+    if key is None:
+        raise ValueError("Invalid ISBN '%s'." % isbn)
+    existing = session.query(BookIsbn).get(key)
+    if existing is not None:
+        if existing.book_id != book.id:
+            raise ValueError("ISBN '%s' belongs to another book." % isbn)
+        return
+    session.add(BookIsbn(isbn=key, book_id=book.id, kind=ALIAS))
+
+
+def resolve_isbns(session, isbns, options=()):
+    """Return the `{isbn: book}` of the books of `isbns`, in one query.
+
+    ISBNs that are not valid or not of a library book are left out.
+
+    :param session: (Session)
+    The session to query.
+
+    :param isbns: (iterable)
+    ISBN-10 or ISBN-13 codes, with or without separators.
+
+    :param options: (tuple)
+    Loader options of the books.
+    """
+    from bpslibrary.models import Book, BookIsbn
+
+    keys = {}
+    for isbn in isbns:
+        key = normalise_isbn(isbn)
+        if key:
+            keys.setdefault(key, []).append(isbn)
+    if not keys:
+        return {}
+
+    found = {}
+    for key, book in session.query(BookIsbn.isbn, Book).\
+            join(Book, Book.id == BookIsbn.book_id).\
+            filter(BookIsbn.isbn.in_(list(keys))).\
+            options(*options):
+        for isbn in keys[key]:
+            found[isbn] = book
+    return found
+
+
+def resolve_isbn(session, isbn):
+    """Return the book of `isbn`, or None, see :func:`resolve_isbns`."""
+    return resolve_isbns(session, [isbn]).get(isbn)
+
+
+def _after_insert(mapper, connection, target):
+    """Write the keys of a new book."""
+    write_keys(connection, target.id, target.isbn13, target.isbn10)
+
+
+def _after_update(mapper, connection, target):
+    """Rewrite the keys of a book whose ISBNs changed."""
+    attrs = inspect(target).attrs
+    if attrs.isbn13.history.has_changes() or \
+            attrs.isbn10.history.has_changes():
+        write_keys(connection, target.id, target.isbn13, target.isbn10)
+
+
+def _after_delete(mapper, connection, target):
+    """Drop all keys of a deleted book."""
+    from bpslibrary.models import BookIsbn
+    table = BookIsbn.__table__
+    connection.execute(table.delete().where(table.c.book_id == target.id))
+
+
+def init_isbn_keys(session):
+    """Build the keys if there are none and start following books.
+
+    :param session: (Session)
+    The session used to check and build the keys.
+    """
+    from bpslibrary.models import Book, BookIsbn
+
+    if session.query(BookIsbn.isbn).first() is None and \
+            session.query(Book.id).first() is not None:
+        sync_isbn_keys(session.connection())
+        session.commit()
+
+    if not event.contains(Book, 'after_insert', _after_insert):
+        event.listen(Book, 'after_insert', _after_insert)
+        event.listen(Book, 'after_update', _after_update)
+        event.listen(Book, 'after_delete', _after_delete)
@@ -0,0 +1,39 @@
+"""
+Loan queries
+============
+
+Queries of the books on loan, filtered and paged in the database.
+"""
+
+from bpslibrary.models import Book, Classroom, Loan, Pupil
+from bpslibrary.utils.pagination import paginate_books
+
+
+def books_on_loan(session, user=None):
+    """Query books with an open loan, to the classroom of `user` if provided.
+
+    :param session: (Session)
+    The session to query.
+
+    :param user: (User)
+    The classroom user whose pupils' loans are wanted, or None for all.
+    """
+    query = session.query(Book).\
+        join(Loan, Loan.book_id == Book.id).\
+        filter(Loan.end_date.is_(None))
+    if user is not None:
+        query = query.join(Loan.pupil).\
+            join(Pupil.classroom).\
+            filter(Classroom.user_id == user.id)
+    return query.distinct()
+
+
+def page_books_on_loan(session, user, page, per_page, options=()):
+    """Return the total and the page of books on loan.
+
+    See :func:`books_on_loan` and
+    :func:`bpslibrary.utils.pagination.paginate_books`.
+    """
+    key = ('loans', user.id if user is not None else None)
+    return paginate_books(key, books_on_loan(session, user),
+                          page, per_page, options)
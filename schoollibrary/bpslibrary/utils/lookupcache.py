@@ -0,0 +1,197 @@
+"""
+Lookup cache
+============
+
+A persistent cache of the raw responses of the online book information
+providers, kept in a SQLite file next to the library database.
+
+Entries are keyed by provider and query. Found responses live for
+`LOOKUP_CACHE_TTL` seconds and "not found" responses for the shorter
+`LOOKUP_CACHE_NEGATIVE_TTL`, so a book missing today is looked up again
+soon. Every `EVICT_CHECK_EVERY` writes, expired entries are dropped and,
+when the stored responses exceed `LOOKUP_CACHE_MAX_BYTES`, the least
+recently used entries are evicted. The last use of hits is recorded in
+batches rather than on every read. Hits and misses are counted per
+process.
+"""
+
+import sqlite3
+import threading
+import time
+from collections import Counter
+from bpslibrary import app
+
+
+CREATE_SQL = """
+    CREATE TABLE IF NOT EXISTS lookup_cache (
+        provider VARCHAR(30) NOT NULL,
+        query VARCHAR(512) NOT NULL,
+        response TEXT,
+        negative INTEGER NOT NULL,
+        expires REAL NOT NULL,
+        last_used REAL NOT NULL,
+        size INTEGER NOT NULL,
+        PRIMARY KEY (provider, query)
+    );
+    CREATE INDEX IF NOT EXISTS ix_lookup_cache_last_used
+        ON lookup_cache (last_used);
+    """
+
+# number of entries evicted at a time when over the size cap
+EVICT_BATCH = 100
+
+# writes between two checks of the size of the cache
+EVICT_CHECK_EVERY = 50
+
+# hits whose last use is recorded at a time
+TOUCH_BATCH = 50
+
+
+class LookupCache():
+    """A persistent, size capped cache of provider responses.
+
+    :param path: (str)
+    The SQLite file holding the cache.
+
+    :param ttl: (int)
+    Seconds a found response is kept.
+
+    :param negative_ttl: (int)
+    Seconds a "not found" response is kept.
+
+    :param max_bytes: (int)
+    The size of stored responses above which entries are evicted.
+    """
+
+    def __init__(self, path, ttl, negative_ttl, max_bytes):
+        """Initialise a LookupCache, creating the file if needed."""
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_bytes = max_bytes
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._connection = None
+        self._writes = 0
+        # (provider, query): last use of hits not yet recorded
+        self._touched = {}
+
+    def _connect(self):
+        """Return the connection of this process, opening it on first use.
+        """
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path,
+                                               timeout=5,
+                                               check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode = WAL;')
+            self._connection.executescript(CREATE_SQL)
+        return self._connection
+
+    def get(self, provider, query):
+        """Return a `(found, response, negative)` triple.
+
+        `found` is False on a miss. A cached "not found" response is
+        returned with `negative` set.
+        """
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute(
+                'SELECT response, negative FROM lookup_cache '
+                'WHERE provider = ? AND query = ? AND expires > ?;',
+                (provider, query, now)).fetchone()
+
+            if row is None:
+                self.stats['misses'] += 1
+                return False, None, False
+
+            self._touched[(provider, query)] = now
+            if len(self._touched) >= TOUCH_BATCH:
+                self._record_touches(connection)
+                connection.commit()
+
+        self.stats['negative_hits' if row[1] else 'hits'] += 1
+        return True, row[0], bool(row[1])
+
+    def set(self, provider, query, response, negative=False):
+        """Store `response`, a "not found" response if `negative` is set."""
+        now = time.time()
+        ttl = self.negative_ttl if negative else self.ttl
+        size = len(response or '')
+
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                'INSERT OR REPLACE INTO lookup_cache '
+                '(provider, query, response, negative, expires, last_used, '
+                'size) VALUES (?, ?, ?, ?, ?, ?, ?);',
+                (provider, query, response, int(negative),
+                 now + ttl, now, size))
+            self._touched.pop((provider, query), None)
+            self._writes += 1
+            if self._writes >= EVICT_CHECK_EVERY:
+                self._writes = 0
+                self._evict(connection, now)
+            connection.commit()
+
+    def _record_touches(self, connection):
+        """Write the last use of the hits since the previous call."""
+        connection.executemany(
+            'UPDATE lookup_cache SET last_used = ? '
+            'WHERE provider = ? AND query = ?;',
+            [(last_used, provider, query)
+             for (provider, query), last_used in self._touched.items()])
+        self._touched.clear()
+
+    def _evict(self, connection, now):
+        """Drop expired entries, then the least recently used ones."""
+        self._record_touches(connection)
+        cursor = connection.execute(
+            'DELETE FROM lookup_cache WHERE expires <= ?;', (now,))
+        self.stats['expired'] += max(cursor.rowcount, 0)
+        total = connection.execute(
+            'SELECT coalesce(sum(size), 0) FROM lookup_cache;').fetchone()[0]
+
+        while total > self.max_bytes:
+            batch = connection.execute(
+                'SELECT rowid, size FROM lookup_cache '
+                'ORDER BY last_used LIMIT ?;', (EVICT_BATCH,)).fetchall()
+            if not batch:
+                break
+            cursor = connection.executemany(
+                'DELETE FROM lookup_cache WHERE rowid = ?;',
+                [(rowid,) for rowid, _ in batch])
+            self.stats['evictions'] += max(cursor.rowcount, 0)
+            total -= sum(size for _, size in batch)
+
+    def fetch(self, provider, query, lookup):
+        """Return the cached response of `query`, calling `lookup` on a miss.
+
+        :param provider: (str)
+        The provider name, e.g. `google`.
+
+        :param query: (str)
+        The query identifying the response within the provider.
+
+        :param lookup: (callable)
+        Returns a `(response, negative)` pair from the provider; a
+        `response` of None (e.g. on errors) is not cached.
+        """
+        if not self.path:
+            return lookup()[0]
+
+        found, response, _ = self.get(provider, query)
+        if found:
+            return response
+
+        response, negative = lookup()
+        if response is not None:
+            self.set(provider, query, response, negative)
+        return response
+
+
+# pylint: disable=C0103
+lookup_cache = LookupCache(app.config['LOOKUP_CACHE_PATH'],
+                           app.config['LOOKUP_CACHE_TTL'],
+                           app.config['LOOKUP_CACHE_NEGATIVE_TTL'],
+                           app.config['LOOKUP_CACHE_MAX_BYTES'])
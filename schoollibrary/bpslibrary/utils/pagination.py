@@ -0,0 +1,220 @@
+"""
+Pagination
+==========
+
+Keyset (seek) pagination of book listings.
+
+Books are listed in `(title, id)` order, which the composite indexes on
+`books` serve directly. Rather than skipping `(page - 1) * per_page` rows
+with OFFSET, the last `(title, id)` of every page served is remembered
+per listing, and the next page seeks past it. Page numbers stay the only
+request parameter, so the flask_paginate `Pagination` widget keeps
+working; jumping to a page whose predecessor was never served seeks from
+the nearest known page and offsets the remainder.
+
+The total count of each listing is cached alongside its page boundaries.
+Both are dropped when a transaction that wrote books commits, and expire
+after `PAGINATION_CACHE_TTL` seconds so writes from other worker
+processes are picked up. Every search term is a listing of its own, so
+only the `PAGINATION_CACHE_MAX_LISTINGS` listings used last are kept.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import and_, event, or_
+from sqlalchemy.orm import Session
+from bpslibrary import app
+
+
+_CHANGED_KEY = 'catalogue_changed'
+
+# the databases sorting null before any other value in ascending order;
+# the others, e.g. postgresql, sort it last
+NULLS_FIRST_DIALECTS = ('sqlite', 'mysql', 'mssql')
+
+
+class ListingCache():
+    """Total counts and page boundaries of listings, keyed by filter.
+
+    :param ttl: (int)
+    Seconds after which an entry is recomputed.
+
+    :param max_pages: (int)
+    The maximum number of page boundaries remembered per listing.
+
+    :param max_listings: (int)
+    The maximum number of listings kept; the least recently used is
+    dropped past it.
+    """
+
+    def __init__(self, ttl, max_pages=1000, max_listings=200):
+        """Initialise an empty ListingCache."""
+        self.ttl = ttl
+        self.max_pages = max_pages
+        self.max_listings = max_listings
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def _entry(self, key):
+        """Return the live entry of `key`, creating it if needed."""
+        entry = self._entries.get(key)
+        if entry is None or entry['expires'] < time.time():
+            entry = {'expires': time.time() + self.ttl,
+                     'total': None,
+                     'boundaries': {}}
+            self._entries[key] = entry
+            while len(self._entries) > self.max_listings:
+                self._entries.popitem(last=False)
+        self._entries.move_to_end(key)
+        return entry
+
+    def __len__(self):
+        """The number of listings kept."""
+        return len(self._entries)
+
+    def total(self, key, count):
+        """Return the cached total of `key`, calling `count` on a miss.
+
+        :param key: (hashable)
+        The listing filter, e.g. `'available'` or `('search', term)`.
+
+        :param count: (callable)
+        Computes the total when it is not cached.
+        """
+        with self._lock:
+            total = self._entry(key)['total']
+        if total is None:
+            total = count()
+            with self._lock:
+                self._entry(key)['total'] = total
+        return total
+
+    def boundary_before(self, key, page):
+        """Return the nearest page before `page` with a known last key.
+
+        Returns a `(page, (title, id))` pair, or `(0, None)` when no
+        earlier page is known.
+        """
+        with self._lock:
+            boundaries = self._entry(key)['boundaries']
+            known = [p for p in boundaries if p < page]
+            if not known:
+                return 0, None
+            nearest = max(known)
+            return nearest, boundaries[nearest]
+
+    def set_boundary(self, key, page, last_key):
+        """Remember `last_key`, the `(title, id)` of the end of `page`."""
+        with self._lock:
+            boundaries = self._entry(key)['boundaries']
+            if page in boundaries or len(boundaries) < self.max_pages:
+                boundaries[page] = last_key
+
+    def clear(self):
+        """Drop all cached totals and boundaries."""
+        with self._lock:
+            self._entries.clear()
+
+
+# pylint: disable=C0103
+listing_cache = ListingCache(app.config['PAGINATION_CACHE_TTL'],
+                             max_listings=app.config[
+                                 'PAGINATION_CACHE_MAX_LISTINGS'])
+
+
+def seek_after(model, last_key, nulls_first=True):
+    """Filter rows that come after `last_key` in `(title, id)` order.
+
+    :param model: (Model)
+    The model ordered by its `title` and `id` columns.
+
+    :param last_key: (tuple)
+    The `(title, id)` of the last row of the previous page.
+
+    :param nulls_first: (bool)
+    Whether the database sorts null titles before the others.
+    """
+    title, last_id = last_key
+    if title is None:
+        after_nulls = and_(model.title.is_(None), model.id > last_id)
+        if nulls_first:
+            return or_(model.title.isnot(None), after_nulls)
+        return after_nulls
+    after_title = or_(model.title > title,
+                      and_(model.title == title, model.id > last_id))
+    if nulls_first:
+        return after_title
+    return or_(after_title, model.title.is_(None))
+
+
+def paginate_books(key, query, page, per_page, options=()):
+    """Return the total number of books and the books of `page`.
+
+    :param key: (hashable)
+    Identifies the filter of `query` in the listing cache.
+
+    :param query: (Query)
+    A query of books, filtered but not ordered.
+
+    :param page: (int)
+    The 1-based page number.
+
+    :param per_page: (int)
+    The number of books per page.
+
+    :param options: (tuple)
+    Loader options applied to the books query.
+    """
+    from bpslibrary.database import engine
+    from bpslibrary.models import Book
+
+    page = max(page, 1)
+    total = listing_cache.total(key, query.count)
+    books_query = query.options(*options).order_by(Book.title, Book.id)
+
+    if not app.config['KEYSET_PAGINATION']:
+        books = books_query.\
+            limit(per_page).offset((page - 1) * per_page).all()
+        return total, books
+
+    known_page, last_key = listing_cache.boundary_before(key, page)
+    if last_key is not None:
+        books_query = books_query.filter(seek_after(
+            Book, last_key,
+            engine.dialect.name in NULLS_FIRST_DIALECTS))
+
+    books = books_query.\
+        limit(per_page).offset((page - 1 - known_page) * per_page).all()
+
+    if books:
+        listing_cache.set_boundary(key, page,
+                                   (books[-1].title, books[-1].id))
+    return total, books
+
+
+def _after_flush(session, flush_context):
+    """Flag the session when the flush wrote books."""
+    from bpslibrary.models import Book
+
+    for obj in list(session.new) + list(session.dirty) + \
+            list(session.deleted):
+        if isinstance(obj, Book):
+            session.info[_CHANGED_KEY] = True
+            return
+
+
+def _after_commit(session):
+    """Invalidate the listings after a commit that wrote books."""
+    if session.info.pop(_CHANGED_KEY, False):
+        listing_cache.clear()
+
+
+def _after_rollback(session, previous_transaction):
+    """Forget the flag of a rolled back transaction."""
+    session.info.pop(_CHANGED_KEY, None)
+
+
+event.listen(Session, 'after_flush', _after_flush)
+event.listen(Session, 'after_commit', _after_commit)
+event.listen(Session, 'after_soft_rollback', _after_rollback)
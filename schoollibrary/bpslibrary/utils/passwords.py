@@ -0,0 +1,208 @@
+"""
+Passwords
+=========
+
+Password hashing with a bcrypt cost calibrated to the host, and limits on
+login attempts.
+
+The cost is the number of rounds whose hash takes about
+`BCRYPT_TARGET_SECONDS` on this host, within `BCRYPT_MIN_ROUNDS` and
+`BCRYPT_MAX_ROUNDS`; it is measured once per process, on first use. With
+no target set, `BCRYPT_LOG_ROUNDS` is used. A password whose hash has a
+lower cost, or one above the maximum, is hashed again on its next login.
+Hashes are only ever raised to the cost of the process, so processes
+calibrated a round apart do not rehash each other's hashes back and forth.
+
+Passwords are checked on a small pool of threads, so at most
+`PASSWORD_WORKERS` checks take CPU at a time however many users log in at
+once. Login attempts are rate limited with token buckets kept in the
+process: every attempt of a client address takes a token, and a user's
+token is only taken by a wrong password, so logging in does not use up
+the attempts of the user. A password is only checked while both have
+tokens left. The `LOGIN_THROTTLE_MAX_KEYS` buckets used last are kept; a
+dropped bucket starts again full.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from bpslibrary import app, bcrypt
+
+
+def hash_cost(pw_hash):
+    """Return the rounds of the bcrypt hash `pw_hash`, None if unknown."""
+    if isinstance(pw_hash, bytes):
+        pw_hash = pw_hash.decode('ascii', 'replace')
+    try:
+        return int(pw_hash.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class PasswordHasher():
+    """Hashes and checks passwords at a calibrated bcrypt cost.
+
+    :param target_seconds: (float)
+    The time a hash should take; the cost is `rounds` if not set.
+
+    :param min_rounds: (int)
+    The lowest cost calibration may choose.
+
+    :param max_rounds: (int)
+    The highest cost calibration may choose.
+
+    :param max_workers: (int)
+    The number of passwords checked at a time.
+
+    :param rounds: (int)
+    The cost used when there is no target.
+    """
+
+    def __init__(self, target_seconds, min_rounds, max_rounds, max_workers,
+                 rounds=12):
+        """Initialise a PasswordHasher."""
+        self.target_seconds = target_seconds
+        self.min_rounds = min_rounds
+        self.max_rounds = max_rounds
+        self.max_workers = max_workers
+        self._rounds = None if target_seconds else rounds
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def rounds(self):
+        """The cost of new hashes, calibrated on first use."""
+        with self._lock:
+            if self._rounds is None:
+                self._rounds = self.calibrate()
+            return self._rounds
+
+    def calibrate(self):
+        """Return the rounds whose hash takes about `target_seconds`.
+
+        A hash is timed at `min_rounds`; every further round doubles it.
+        """
+        started = time.perf_counter()
+        bcrypt.generate_password_hash('calibration', self.min_rounds)
+        seconds = max(time.perf_counter() - started, 1e-6)
+        rounds = self.min_rounds + \
+            int(math.floor(math.log2(self.target_seconds / seconds) + 0.5))
+        rounds = min(self.max_rounds, max(self.min_rounds, rounds))
+        app.logger.info("bcrypt cost calibrated to %d rounds "
+                        "(%.0f ms at %d rounds)",
+                        rounds, 1000 * seconds, self.min_rounds)
+        return rounds
+
+    def hash(self, password):
+        """Return the hash of `password` at the current cost."""
+        return bcrypt.generate_password_hash(password, self.rounds)
+
+    def needs_rehash(self, pw_hash):
+        """Tell whether `pw_hash` is below the current cost or too costly.
+        """
+        cost = hash_cost(pw_hash)
+        return cost is None or cost < self.rounds or cost > self.max_rounds
+
+    def verify(self, pw_hash, password):
+        """Check `password` against `pw_hash` on the checking threads."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='passwords')
+            executor = self._executor
+        return executor.submit(bcrypt.check_password_hash,
+                               pw_hash, password).result()
+
+
+class LoginThrottle():
+    """Token buckets of login attempts, the `max_keys` used last kept.
+
+    :param max_keys: (int)
+    The most buckets kept; the least recently used is dropped past it.
+    """
+
+    def __init__(self, max_keys):
+        """Initialise an empty LoginThrottle."""
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def wait(self, key, rate, burst, take=True):
+        """Return the seconds until `key` has an attempt, 0 if it has one.
+
+        :param rate: (float)
+        Attempts added per second; no limit applies if it is not set.
+
+        :param burst: (int)
+        The most attempts the bucket holds.
+
+        :param take: (bool)
+        Take the attempt if there is one.
+        """
+        if not rate:
+            return 0
+        now = time.time()
+        with self._lock:
+            if key not in self._buckets and not take:
+                return 0
+            tokens, last = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if take and not wait:
+                tokens -= 1
+            # re-inserted as the most recently used
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def __len__(self):
+        """The number of buckets kept."""
+        return len(self._buckets)
+
+    def clear(self):
+        """Forget all buckets."""
+        with self._lock:
+            self._buckets.clear()
+
+
+def login_wait(address, username=None):
+    """Take a login attempt of the client and check those of the user.
+
+    Returns 0 if the attempt may go ahead, otherwise the seconds until
+    the next attempt is allowed.
+
+    :param address: (str)
+    The client address; an attempt is taken.
+
+    :param username: (str)
+    The username tried, of an existing user; no attempt is taken, see
+    :func:`login_failed`.
+    """
+    if username is None:
+        return login_throttle.wait('ip:' + (address or 'unknown'),
+                                   app.config['LOGIN_IP_RATE'],
+                                   app.config['LOGIN_IP_BURST'])
+    return login_throttle.wait('user:' + username.lower(),
+                               app.config['LOGIN_USER_RATE'],
+                               app.config['LOGIN_USER_BURST'],
+                               take=False)
+
+
+def login_failed(username):
+    """Take an attempt of the user, after a wrong password."""
+    login_throttle.wait('user:' + username.lower(),
+                        app.config['LOGIN_USER_RATE'],
+                        app.config['LOGIN_USER_BURST'])
+
+
+# pylint: disable=C0103
+login_throttle = LoginThrottle(app.config['LOGIN_THROTTLE_MAX_KEYS'])
+password_hasher = PasswordHasher(app.config['BCRYPT_TARGET_SECONDS'],
+                                 app.config['BCRYPT_MIN_ROUNDS'],
+                                 app.config['BCRYPT_MAX_ROUNDS'],
+                                 app.config['PASSWORD_WORKERS'],
+                                 app.config['BCRYPT_LOG_ROUNDS'])
@@ -0,0 +1,118 @@
+"""
+Rate limit
+==========
+
+Token bucket rate limiting of the calls to the online book information
+providers.
+
+Every provider host has a bucket holding up to `burst` tokens, refilled
+at `rate` tokens per second. A call takes a token, waiting for one if the
+bucket is empty, so lookups run as fast as the provider's quota allows
+and no faster. Callers that cannot wait long, such as the views, pass a
+`max_wait` and get :class:`RateLimitExceeded` when the next token is
+further off.
+
+The state of a bucket lives in a small file under `RATE_LIMIT_DIR`,
+locked with `flock` while it is updated, so the quota is shared by all
+threads and all worker processes of the application.
+"""
+
+import fcntl
+import os
+import struct
+import threading
+import time
+from bpslibrary import app
+
+
+# tokens, last refill time
+STATE = struct.Struct('<dd')
+
+
+class RateLimitExceeded(ValueError):
+    """No token of a host is due within the time the caller can wait."""
+
+
+class RateLimiter():
+    """Token buckets of provider hosts, shared through lock files.
+
+    :param directory: (str)
+    The directory holding the bucket state files. Rate limiting is
+    disabled if it is empty.
+    """
+
+    def __init__(self, directory):
+        """Initialise a RateLimiter."""
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def _bucket(self, host):
+        """Return the `(fd, lock)` of the bucket of `host`."""
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                os.makedirs(self.directory, exist_ok=True)
+                fd = os.open(os.path.join(self.directory, host + '.bucket'),
+                             os.O_RDWR | os.O_CREAT, 0o644)
+                bucket = self._buckets[host] = (fd, threading.Lock())
+            return bucket
+
+    def try_acquire(self, host, rate, burst):
+        """Take a token of `host` if there is one.
+
+        Returns 0 on success, otherwise the seconds until a token is due.
+        """
+        fd, lock = self._bucket(host)
+
+        with lock:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                data = os.pread(fd, STATE.size, 0)
+                if len(data) == STATE.size:
+                    tokens, last = STATE.unpack(data)
+                    tokens = min(burst, tokens + (now - last) * rate)
+                else:
+                    tokens = burst
+
+                if tokens >= 1:
+                    os.pwrite(fd, STATE.pack(tokens - 1, now), 0)
+                    return 0
+                os.pwrite(fd, STATE.pack(tokens, now), 0)
+                return (1 - tokens) / rate
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def acquire(self, host, rate, burst=1, max_wait=None):
+        """Wait for and take a token of `host`.
+
+        :param host: (str)
+        The provider host name.
+
+        :param rate: (float)
+        Tokens added per second; no limit applies if it is not set.
+
+        :param burst: (int)
+        The most tokens the bucket holds, i.e. calls made back to back.
+
+        :param max_wait: (float)
+        The most seconds to wait; :class:`RateLimitExceeded` is raised,
+        without taking a token, if none is due by then. Waits as long as
+        needed if not set.
+        """
+        if not self.directory or not rate:
+            return
+        deadline = None if max_wait is None else time.time() + max_wait
+        wait = self.try_acquire(host, rate, burst)
+        while wait:
+            if deadline is not None and time.time() + wait > deadline:
+                raise RateLimitExceeded(
+                    "%s is rate limited, next call in %.0f seconds"
+                    % (host, wait))
+            time.sleep(wait)
+            wait = self.try_acquire(host, rate, burst)
+
+
+# pylint: disable=C0103
+rate_limiter = RateLimiter(app.config['RATE_LIMIT_DIR'])
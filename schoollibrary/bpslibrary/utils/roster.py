@@ -0,0 +1,229 @@
+"""
+Roster
+======
+
+Set-based import of classroom rosters from CSV files.
+
+Every row of a roster file holds a classroom name, the classroom year
+group and a pupil name. The file is streamed in chunks; each chunk adds
+its missing classrooms and pupils with one executemany per table, so
+the import costs a handful of statements per chunk rather than one per
+pupil. Rows may come in any order and uploading the same roster twice
+adds nothing. Pupils are matched by classroom and name, counting
+repeats: a class listing two pupils of the same name gets both. Invalid
+rows are reported without aborting the import.
+"""
+
+import csv
+from collections import Counter, defaultdict
+from itertools import islice
+from sqlalchemy import bindparam
+
+
+CHUNK_SIZE = 500
+
+
+class RosterReport():
+    """The outcome of a roster import."""
+
+    def __init__(self):
+        """Initialise an empty RosterReport."""
+        self.rows = 0
+        self.classrooms_added = 0
+        self.pupils_added = 0
+        self.pupils_removed = 0
+        self.errors = []
+
+    def add_error(self, line_number, message):
+        """Record an error of the row at `line_number`."""
+        self.errors.append((line_number, message))
+
+    def __repr__(self):
+        """RosterReport representation."""
+        return "<RosterReport %d rows, %d errors>" % \
+            (self.rows, len(self.errors))
+
+
+def parse_row(row):
+    """Validate a CSV row, returning (classroom, year, pupil).
+
+    Raises ValueError if the row is not valid.
+    """
+    if len(row) < 3:
+        raise ValueError("Expected classroom, year and pupil name.")
+
+    classroom_name, year, pupil_name = (c.strip() for c in row[:3])
+
+    if not classroom_name:
+        raise ValueError("Missing classroom name.")
+    if not pupil_name:
+        raise ValueError("Missing pupil name.")
+    try:
+        year = int(year)
+    except ValueError:
+        raise ValueError("Invalid year '%s'." % year)
+
+    return classroom_name, year, pupil_name
+
+
+class RosterImporter():
+    """Import classroom rosters into the database.
+
+    :param session: (Session)
+    The session to write through; the import is committed as a whole.
+
+    :param replace: (bool)
+    If set, pupils of the uploaded classrooms who are not in the file are
+    taken off their classroom (their loan history is kept).
+
+    :param chunk_size: (int)
+    The number of rows written per batch.
+    """
+
+    def __init__(self, session, replace=False, chunk_size=CHUNK_SIZE):
+        """Initialise a RosterImporter."""
+        self.session = session
+        self.replace = replace
+        self.chunk_size = chunk_size
+        self.report = RosterReport()
+        self._classrooms = {}
+        self._years = {}
+        # (classroom id, name): pupils in the database, and in the file
+        self._pupils = Counter()
+        self._seen_pupils = Counter()
+        # (classroom id, name): ids of the pupils there before the import
+        self._pupil_ids = defaultdict(list)
+        self._loaded_classrooms = set()
+
+    def import_file(self, csv_file):
+        """Import all rows of the open `csv_file`, then commit.
+
+        Returns a :class:`RosterReport`. Database errors roll back the
+        whole import and are raised.
+        """
+        from bpslibrary.models import Classroom
+
+        reader = csv.reader(csv_file, delimiter=',', quotechar='"')
+        rows = enumerate(reader, start=1)
+
+        # load the existing classrooms once, there are few of them
+        for cr_id, name, year in self.session.query(
+                Classroom.id, Classroom.name, Classroom.year):
+            self._classrooms[name] = cr_id
+            self._years[name] = year
+
+        try:
+            while True:
+                chunk = list(islice(rows, self.chunk_size))
+                if not chunk:
+                    break
+                self._import_chunk(chunk)
+
+            if self.replace:
+                self._remove_missing_pupils()
+
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+        return self.report
+
+    def _import_chunk(self, chunk):
+        """Write the classrooms and pupils of a chunk of rows."""
+        entries = []
+        for line_number, row in chunk:
+            if not row:
+                continue
+            self.report.rows += 1
+            try:
+                entries.append(parse_row(row))
+            except ValueError as err:
+                self.report.add_error(line_number, str(err))
+
+        self._upsert_classrooms(entries)
+        self._load_pupils({self._classrooms[e[0]] for e in entries})
+
+        new_pupils = []
+        for classroom_name, _, pupil_name in entries:
+            key = (self._classrooms[classroom_name], pupil_name)
+            self._seen_pupils[key] += 1
+            if self._seen_pupils[key] > self._pupils[key]:
+                self._pupils[key] += 1
+                new_pupils.append({'classroom_id': key[0], 'name': key[1]})
+
+        if new_pupils:
+            from bpslibrary.models import Pupil
+            self.session.execute(Pupil.__table__.insert(), new_pupils)
+            self.report.pupils_added += len(new_pupils)
+
+    def _upsert_classrooms(self, entries):
+        """Add missing classrooms and update changed year groups."""
+        from bpslibrary.models import Classroom
+        table = Classroom.__table__
+
+        new_classrooms = {}
+        changed_years = {}
+        for classroom_name, year, _ in entries:
+            if classroom_name not in self._classrooms:
+                new_classrooms[classroom_name] = year
+            elif self._years[classroom_name] != year:
+                changed_years[classroom_name] = year
+            self._years[classroom_name] = year
+
+        if changed_years:
+            self.session.execute(
+                table.update().
+                where(table.c.name == bindparam('b_name')).
+                values(year=bindparam('b_year')),
+                [{'b_name': n, 'b_year': y}
+                 for n, y in changed_years.items()])
+
+        if new_classrooms:
+            self.session.execute(
+                table.insert(),
+                [{'name': n, 'year': y} for n, y in new_classrooms.items()])
+            self.report.classrooms_added += len(new_classrooms)
+            for cr_id, name in self.session.query(
+                    Classroom.id, Classroom.name).\
+                    filter(Classroom.name.in_(list(new_classrooms))):
+                self._classrooms[name] = cr_id
+
+    def _load_pupils(self, classroom_ids):
+        """Load the pupils of classrooms not seen in earlier chunks."""
+        from bpslibrary.models import Pupil
+
+        missing = [i for i in classroom_ids
+                   if i not in self._loaded_classrooms]
+        if not missing:
+            return
+        self._loaded_classrooms.update(missing)
+        for pupil_id, classroom_id, name in self.session.query(
+                Pupil.id, Pupil.classroom_id, Pupil.name).\
+                filter(Pupil.classroom_id.in_(missing)).\
+                order_by(Pupil.id):
+            self._pupils[(classroom_id, name)] += 1
+            self._pupil_ids[(classroom_id, name)].append(pupil_id)
+
+    def _remove_missing_pupils(self):
+        """Take pupils not in the upload off the uploaded classrooms."""
+        from bpslibrary.models import Pupil
+        table = Pupil.__table__
+
+        # of pupils sharing a name, the latest added go first
+        gone = [pupil_id
+                for key, count in (self._pupils - self._seen_pupils).items()
+                for pupil_id in self._pupil_ids[key][-count:]]
+        if not gone:
+            return
+        self.session.execute(
+            table.update().
+            where(table.c.id == bindparam('b_id')).
+            values(classroom_id=None),
+            [{'b_id': pupil_id} for pupil_id in gone])
+        self.report.pupils_removed += len(gone)
+
+
+def import_roster(session, csv_file, replace=False):
+    """Import the roster in `csv_file`, see :class:`RosterImporter`."""
+    return RosterImporter(session, replace).import_file(csv_file)
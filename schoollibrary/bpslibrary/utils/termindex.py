@@ -0,0 +1,282 @@
+"""
+Term index
+==========
+
+A process-wide index of book titles, author names and category names,
+used to feed the search box autocomplete without scanning the catalogue
+on every request.
+
+The index is loaded once at startup by :func:`init_term_index` and is then
+kept up to date by SQLAlchemy events: mapper events record the terms added
+or removed by each flush, and the changes are applied to the index only
+when the session commits (they are discarded on rollback).
+
+Every transaction changing terms also increments the version stored in
+the `catalogue_version` table. The version is shared by all worker
+processes: it is the ETag of the suggestions, and a process whose index
+is behind it, after a change committed by another process, reloads its
+index.
+"""
+
+import bisect
+import threading
+from collections import Counter
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session, object_session
+
+
+# the indexed attribute of each model
+INDEXED_ATTRIBUTES = {
+    'Book': 'title',
+    'Author': 'name',
+    'Category': 'name',
+}
+
+_PENDING_KEY = 'term_index_changes'
+_VERSION_KEY = 'term_index_version'
+
+# the row of the catalogue_version table
+VERSION_ID = 1
+
+
+class TermIndex():
+    """A sorted, reference counted set of search terms.
+
+    Every term is counted once per row carrying it, so a term shared by
+    several rows (e.g. an author name that is also a category) only leaves
+    the index once the last of those rows is gone.
+    """
+
+    def __init__(self):
+        """Initialise an empty TermIndex."""
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._keys = []
+        self._terms = []
+        self._version = None
+
+    def __len__(self):
+        """Number of distinct terms in the index."""
+        return len(self._terms)
+
+    @property
+    def version(self):
+        """The catalogue version the index is up to date with."""
+        return self._version
+
+    def advance(self, version):
+        """Move to `version` if the index was at the one just before.
+
+        An index that missed a version keeps its own, and is reloaded by
+        :func:`refresh_term_index`.
+        """
+        with self._lock:
+            if self._version == version - 1:
+                self._version = version
+
+    def load(self, terms, version=None):
+        """Replace the content of the index with `terms`.
+
+        :param terms: (iterable)
+        The terms to index, duplicates are counted.
+
+        :param version: (int)
+        The catalogue version of the terms.
+        """
+        counts = Counter(t for t in terms if t)
+        entries = sorted((t.lower(), t) for t in counts)
+
+        with self._lock:
+            self._counts = counts
+            self._keys = [e[0] for e in entries]
+            self._terms = [e[1] for e in entries]
+            self._version = version
+
+    def add(self, term):
+        """Add an occurrence of `term` to the index."""
+        if not term:
+            return
+
+        with self._lock:
+            self._counts[term] += 1
+            if self._counts[term] == 1:
+                key = term.lower()
+                pos = bisect.bisect_left(self._keys, key)
+                while pos < len(self._keys) and self._keys[pos] == key \
+                        and self._terms[pos] < term:
+                    pos += 1
+                self._keys.insert(pos, key)
+                self._terms.insert(pos, term)
+
+    def discard(self, term):
+        """Remove an occurrence of `term` from the index."""
+        if not term:
+            return
+
+        with self._lock:
+            if self._counts[term] > 1:
+                self._counts[term] -= 1
+                return
+
+            self._counts.pop(term, None)
+            key = term.lower()
+            pos = bisect.bisect_left(self._keys, key)
+            while pos < len(self._keys) and self._keys[pos] == key:
+                if self._terms[pos] == term:
+                    del self._keys[pos]
+                    del self._terms[pos]
+                    break
+                pos += 1
+
+    def lookup(self, prefix, limit=None):
+        """Return the terms starting with `prefix`, ignoring case.
+
+        :param prefix: (str)
+        The prefix to look up.
+
+        :param limit: (int)
+        The maximum number of terms to return, all if not set.
+        """
+        key = (prefix or '').lower()
+
+        with self._lock:
+            start = bisect.bisect_left(self._keys, key)
+            end = bisect.bisect_left(self._keys, key + '\uffff', lo=start)
+            if limit is not None:
+                end = min(end, start + limit)
+            return self._terms[start:end]
+
+    def terms(self):
+        """Return all the terms in the index, sorted ignoring case."""
+        with self._lock:
+            return list(self._terms)
+
+
+# pylint: disable=C0103
+term_index = TermIndex()
+
+
+def _version_table():
+    """Return the catalogue_version table."""
+    from bpslibrary.models import CatalogueVersion
+    return CatalogueVersion.__table__
+
+
+def read_version(connection):
+    """Return the stored catalogue version."""
+    table = _version_table()
+    return connection.execute(select([table.c.version]).
+                              where(table.c.id == VERSION_ID)).scalar()
+
+
+def _record_change(connection, target, removed, added):
+    """Queue a change to the index until the session commits.
+
+    The stored catalogue version is incremented once per transaction.
+    """
+    session = object_session(target)
+    if session is None:
+        return
+    session.info.setdefault(_PENDING_KEY, []).append((removed, added))
+
+    if _VERSION_KEY not in session.info:
+        table = _version_table()
+        connection.execute(table.update().
+                           where(table.c.id == VERSION_ID).
+                           values(version=table.c.version + 1))
+        session.info[_VERSION_KEY] = read_version(connection)
+
+
+def _on_set(target, value, oldvalue, initiator):
+    """Nothing to do; registered so the replaced term is always loaded."""
+
+
+def _after_insert(mapper, connection, target):
+    """Queue the term of a newly inserted row."""
+    attr = INDEXED_ATTRIBUTES[mapper.class_.__name__]
+    _record_change(connection, target, None, getattr(target, attr))
+
+
+def _after_update(mapper, connection, target):
+    """Queue the old and new terms of an updated row."""
+    attr = INDEXED_ATTRIBUTES[mapper.class_.__name__]
+    history = inspect(target).attrs[attr].history
+    if not history.has_changes():
+        return
+    removed = history.deleted[0] if history.deleted else None
+    added = history.added[0] if history.added else None
+    _record_change(connection, target, removed, added)
+
+
+def _after_delete(mapper, connection, target):
+    """Queue the term of a deleted row for removal."""
+    attr = INDEXED_ATTRIBUTES[mapper.class_.__name__]
+    history = inspect(target).attrs[attr].history
+    removed = history.deleted[0] if history.deleted \
+        else getattr(target, attr)
+    _record_change(connection, target, removed, None)
+
+
+def _after_commit(session):
+    """Apply the queued changes to the index."""
+    for removed, added in session.info.pop(_PENDING_KEY, []):
+        term_index.discard(removed)
+        term_index.add(added)
+    version = session.info.pop(_VERSION_KEY, None)
+    if version is not None:
+        term_index.advance(version)
+
+
+def _after_rollback(session, previous_transaction):
+    """Drop the queued changes of a rolled back transaction."""
+    session.info.pop(_PENDING_KEY, None)
+    session.info.pop(_VERSION_KEY, None)
+
+
+def load_term_index(session):
+    """Load the index with the current terms and catalogue version."""
+    from bpslibrary.models import Author, Book, Category
+
+    version = read_version(session.connection())
+    terms = [t for (t,) in session.query(Book.title)]
+    terms += [n for (n,) in session.query(Author.name)]
+    terms += [n for (n,) in session.query(Category.name)]
+    term_index.load(terms, version)
+
+
+def refresh_term_index(session):
+    """Reload the index if it is behind the stored catalogue version.
+
+    Returns the catalogue version of the index.
+    """
+    if read_version(session.connection()) != term_index.version:
+        load_term_index(session)
+    return term_index.version
+
+
+def init_term_index(session):
+    """Load the index from the database and start listening for changes.
+
+    :param session: (Session)
+    The session used to load the current terms.
+    """
+    from bpslibrary.models import Author, Book, Category
+
+    if read_version(session.connection()) is None:
+        session.execute(_version_table().insert().
+                        values(id=VERSION_ID, version=0))
+        session.commit()
+    load_term_index(session)
+
+    for model in (Book, Author, Category):
+        if event.contains(model, 'after_insert', _after_insert):
+            continue
+        event.listen(model, 'after_insert', _after_insert)
+        event.listen(model, 'after_update', _after_update)
+        event.listen(model, 'after_delete', _after_delete)
+        event.listen(getattr(model, INDEXED_ATTRIBUTES[model.__name__]),
+                     'set', _on_set, active_history=True)
+
+    if not event.contains(Session, 'after_commit', _after_commit):
+        event.listen(Session, 'after_commit', _after_commit)
+        event.listen(Session, 'after_soft_rollback', _after_rollback)
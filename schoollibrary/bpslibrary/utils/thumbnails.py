@@ -0,0 +1,273 @@
+"""
+Thumbnails
+==========
+
+Downloads of book cover images, off the request path.
+
+Covers are fetched by a small pool of worker threads. Every image is
+stored under the hash of its content, so the same cover found for several
+books (or downloaded twice) is kept once, and files are written to a
+temporary file and renamed into place, so a reader never sees a partial
+image. Once stored, the name of the file is recorded on the book.
+
+For every stored image, fixed width derivatives are rendered in WebP and
+JPEG under `derived/`, named after the content hash of the original, so
+their urls can be cached by browsers forever. `flask backfill-thumbnails`
+moves existing covers to the content-addressed store and renders their
+derivatives.
+"""
+
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import click
+from flask import url_for
+from PIL import Image
+from bpslibrary import app
+from bpslibrary.utils.httpclient import http_get
+
+
+# leading bytes of the image formats providers return
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+)
+
+
+def image_extension(data):
+    """Return the file extension of the image in `data`."""
+    for signature, extension in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return extension
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return '.webp'
+    return '.jpg'
+
+
+def write_atomic(path, data):
+    """Write `data` to `path` through a temporary file and a rename."""
+    temp_fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                          suffix='.tmp')
+    try:
+        with os.fdopen(temp_fd, 'wb') as temp_file:
+            temp_file.write(data)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except OSError:
+        os.unlink(temp_path)
+        raise
+
+
+def derivative_name(image_name, width, extension):
+    """Return the file name of a derivative of a stored image."""
+    return '%s-%d.%s' % (os.path.splitext(image_name)[0], width, extension)
+
+
+class ThumbnailService():
+    """Downloads covers into a content-addressed directory.
+
+    :param directory: (str)
+    The directory the thumbnails are stored in.
+
+    :param max_workers: (int)
+    The number of concurrent downloads.
+
+    :param widths: (tuple)
+    The widths in pixels of the derivatives of every image.
+    """
+
+    def __init__(self, directory, max_workers, widths=(96, 192)):
+        """Initialise a ThumbnailService."""
+        self.directory = directory
+        self.derived_directory = os.path.join(directory, 'derived')
+        self.max_workers = max_workers
+        self.widths = widths
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = {}
+
+    def store(self, data):
+        """Store the image `data` and its derivatives, return its name.
+
+        An image already stored is not written again.
+        """
+        image_name = hashlib.sha256(data).hexdigest() + image_extension(data)
+        path = os.path.join(self.directory, image_name)
+        if not os.path.exists(path):
+            write_atomic(path, data)
+        if not self.has_derivatives(image_name):
+            try:
+                self.derive(image_name, data)
+            except (OSError, ValueError) as err:
+                app.logger.warning("Derivatives of %s failed: %s",
+                                   image_name, err)
+        return image_name
+
+    def has_derivatives(self, image_name):
+        """Tell whether the derivatives of `image_name` are rendered."""
+        return os.path.exists(os.path.join(
+            self.derived_directory,
+            derivative_name(image_name, max(self.widths), 'jpg')))
+
+    def derive(self, image_name, data):
+        """Render the WebP and JPEG derivatives of a stored image.
+
+        Images narrower than a derivative width are not enlarged.
+        """
+        os.makedirs(self.derived_directory, exist_ok=True)
+        image = Image.open(io.BytesIO(data))
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGBA').convert('RGB')
+
+        for width in sorted(self.widths):
+            resized = image
+            if image.width > width:
+                height = max(1, round(image.height * width / image.width))
+                resized = image.resize((width, height), Image.LANCZOS)
+
+            for extension, options in (
+                    ('webp', {'format': 'WEBP', 'quality': 80}),
+                    ('jpg', {'format': 'JPEG', 'quality': 85,
+                             'optimize': True, 'progressive': True})):
+                output = io.BytesIO()
+                resized.save(output, **options)
+                # the largest jpeg marks the set complete, so it goes last
+                write_atomic(os.path.join(
+                    self.derived_directory,
+                    derivative_name(image_name, width, extension)),
+                             output.getvalue())
+
+    def cover_sources(self, image_name):
+        """Return the `srcset` urls of the derivatives of `image_name`.
+
+        Returns a dict with `webp` and `jpeg` srcsets and the `src` of
+        the largest JPEG, or None if there are no derivatives.
+        """
+        if not image_name or not self.has_derivatives(image_name):
+            return None
+
+        def srcset(extension):
+            """Return the srcset of the derivatives in `extension`."""
+            return ', '.join(
+                '%s %dw' % (url_for('books.cover', name=derivative_name(
+                    image_name, width, extension)), width)
+                for width in sorted(self.widths))
+
+        return {'webp': srcset('webp'),
+                'jpeg': srcset('jpg'),
+                'src': url_for('books.cover', name=derivative_name(
+                    image_name, max(self.widths), 'jpg'))}
+
+    def download(self, url):
+        """Download the image at `url` and return its stored file name."""
+        response = http_get(url)
+        response.raise_for_status()
+        return self.store(response.content)
+
+    def queue(self, book_id, url):
+        """Download the cover of a book in the background.
+
+        The stored file name is saved as the book's `image_name`, unless
+        the book's `thumbnail_url` has changed since. Downloads of a url
+        already queued are shared. Returns a future of the file name.
+
+        :param book_id: (int)
+        The id of the book.
+
+        :param url: (str)
+        The url of the cover image.
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='thumbnails')
+            download = self._pending.get(url)
+            if download is None:
+                download = self._pending[url] = \
+                    self._executor.submit(self.download, url)
+                download.add_done_callback(
+                    lambda _: self._forget(url))
+
+        saved = Future()
+
+        def save(finished):
+            """Record the download on the book once it has finished."""
+            try:
+                saved.set_result(self._save(book_id, url, finished))
+            except Exception as err:  # pylint: disable=W0703
+                saved.set_exception(err)
+
+        download.add_done_callback(save)
+        return saved
+
+    def _forget(self, url):
+        """Drop the finished download of `url`."""
+        with self._lock:
+            self._pending.pop(url, None)
+
+    @staticmethod
+    def _save(book_id, url, download):
+        """Record the file name of a finished download on the book."""
+        from bpslibrary.database import engine
+        from bpslibrary.models import Book
+        table = Book.__table__
+
+        try:
+            image_name = download.result()
+        except Exception as err:  # pylint: disable=W0703
+            app.logger.warning("Cover download of book %s from %s failed: %s",
+                               book_id, url, err)
+            return None
+
+        engine.execute(table.update().
+                       where(table.c.id == book_id).
+                       where(table.c.thumbnail_url == url).
+                       values(image_name=image_name))
+        return image_name
+
+
+# pylint: disable=C0103
+thumbnail_service = ThumbnailService(app.config['THUMBNAILS_ABSOLUTE_DIR'],
+                                     app.config['THUMBNAIL_WORKERS'],
+                                     app.config['THUMBNAIL_WIDTHS'])
+app.add_template_global(thumbnail_service.cover_sources, 'cover_sources')
+
+
+@click.command('backfill-thumbnails')
+def backfill_thumbnails():
+    """Store existing covers by content and render their derivatives."""
+    from bpslibrary.database import engine
+    from bpslibrary.models import Book
+    table = Book.__table__
+
+    image_names = [row[0] for row in engine.execute(
+        table.select().with_only_columns([table.c.image_name]).
+        where(table.c.image_name.isnot(None)).distinct())]
+
+    stored = missing = failed = 0
+    for image_name in image_names:
+        path = os.path.join(thumbnail_service.directory, image_name)
+        if not os.path.isfile(path):
+            missing += 1
+            continue
+        try:
+            with open(path, 'rb') as image_file:
+                new_name = thumbnail_service.store(image_file.read())
+        except (OSError, ValueError) as err:
+            click.echo('%s: %s' % (image_name, err), err=True)
+            failed += 1
+            continue
+        if new_name != image_name:
+            engine.execute(table.update().
+                           where(table.c.image_name == image_name).
+                           values(image_name=new_name))
+        stored += 1
+
+    click.echo('%d covers stored, %d missing, %d failed.' %
+               (stored, missing, failed))
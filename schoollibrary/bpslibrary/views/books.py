@@ -2,27 +2,30 @@
 
 # pylint: disable=C0103
 
-from urllib import request as urllib_request
-from time import sleep
-import re
-import random
-import sqlite3
-from flask import Blueprint, flash, redirect, render_template, request
+from flask import (Blueprint, flash, jsonify, redirect, render_template,
+                   request, send_from_directory)
 from flask_paginate import Pagination, get_page_parameter
 from sqlalchemy import exc, or_
 from bpslibrary import app
-from bpslibrary.database import db_session
-from bpslibrary.models import Author, Book, Category
-from bpslibrary.utils.barcode import scan_for_isbn
+from bpslibrary.database import db_session, read_only
+from bpslibrary.models import Author, Book, Category, BOOK_LIST_OPTIONS
 from bpslibrary.utils.apihandler import APIClient
+from bpslibrary.utils.autoload import autoload_job
+from bpslibrary.utils.booksearch import search_books
+from bpslibrary.utils.decoding import decoding_service
+from bpslibrary.utils.isbnkeys import resolve_isbn
+from bpslibrary.utils.pagination import paginate_books
 from bpslibrary.utils.permission import admin_access_required
 from bpslibrary.utils.enums import BookLocation
+from bpslibrary.utils.termindex import refresh_term_index, term_index
+from bpslibrary.utils.thumbnails import thumbnail_service
 from bpslibrary.views.loans import init_loan_forms
 
 mod = Blueprint('books', __name__, url_prefix='/books')
-THUMBNAILS_ABSOLUTE_DIR = app.config['THUMBNAILS_ABSOLUTE_DIR']
 THUMBNAILS_DIR = app.config['THUMBNAILS_DIR']
 PER_PAGE = app.config['PER_PAGE']
+SUGGEST_LIMIT = app.config['SUGGEST_LIMIT']
+SUGGEST_MIN_LENGTH = app.config['SUGGEST_MIN_LENGTH']
 
 
 @mod.route('/')
@@ -49,12 +52,14 @@ def lookup_book():
             if 'barcode' in request.files:
                 barcode_file = request.files['barcode']
                 if not barcode_file.filename == '':
-                    barcode_isbn = scan_for_isbn(barcode_file)
+                    barcode_isbn = \
+                        decoding_service.scan_for_isbn(barcode_file)
 
             if barcode_isbn or input_isbn or book_title:
                 isbns = set(input_isbn + barcode_isbn)
                 isbns.discard('')
-                api_client = APIClient(isbns, book_title)
+                api_client = APIClient(isbns, book_title,
+                                       app.config['HTTP_RATE_MAX_WAIT'])
                 found_books = api_client.find_books()
 
         except ValueError as e:
@@ -99,19 +104,14 @@ def add_book():
             book.categories.append(category)
 
         book.thumbnail_url = request.form['thumbnail_url'].strip()
-        if book.thumbnail_url:
-            title = [c for c in book.title.replace(' ', '_')
-                     if re.match(r'\w', c)]
-            image_name = ''.join(title) + book.isbn13 + '.jpg'
-
-            img = open(THUMBNAILS_ABSOLUTE_DIR + image_name, 'wb')
-            img.write(urllib_request.urlopen(book.thumbnail_url).read())
-            book.image_name = image_name
 
         session = db_session()
         session.add(book)
         session.commit()
 
+        if book.thumbnail_url:
+            thumbnail_service.queue(book.id, book.thumbnail_url)
+
         flash("The book has been added to the library successfully!")
     except RuntimeError as rte:
         error_message = "Something has gone wrong!"
@@ -131,6 +131,7 @@ def validate_add_book():
 
 @mod.route('/edit', methods=['GET', 'POST'])
 @admin_access_required
+@read_only
 def edit_book():
     """Update a book in the library."""
     session = db_session()
@@ -169,13 +170,20 @@ def edit_book():
         if search_title and search_title.strip():
             search_term = '%' + search_title.strip() + '%'
             found_books = session.query(Book).\
+                options(*BOOK_LIST_OPTIONS).\
                 filter(Book.title.ilike(search_term)).all()
 
         if search_isbn and search_isbn.strip():
-            search_term = '%' + search_isbn.strip() + '%'
-            found_books = found_books + session.query(Book).\
-                filter(or_(Book.isbn10.ilike(search_term),
-                           Book.isbn13.ilike(search_term))).all()
+            # a whole ISBN is found through its key, in either form
+            isbn_book = resolve_isbn(session, search_isbn.strip())
+            if isbn_book:
+                found_books = found_books + [isbn_book]
+            else:
+                search_term = '%' + search_isbn.strip() + '%'
+                found_books = found_books + session.query(Book).\
+                    options(*BOOK_LIST_OPTIONS).\
+                    filter(or_(Book.isbn10.ilike(search_term),
+                               Book.isbn13.ilike(search_term))).all()
 
     result = render_template('edit_book.html',
                              lookup_isbns=lookup_isbns,
@@ -233,15 +241,10 @@ def update_book():
                 book.authors.append(Author(author_name))
 
         # thumbnail
-        if update_thumbnail_url and book.thumbnail_url != update_thumbnail_url:
+        new_thumbnail = update_thumbnail_url and \
+            book.thumbnail_url != update_thumbnail_url
+        if new_thumbnail:
             book.thumbnail_url = update_thumbnail_url
-            title = [c for c in book.title.replace(' ', '_')
-                     if re.match(r'\w', c)]
-            image_name = ''.join(title) + book.isbn13 + '.jpg'
-
-            img = open(THUMBNAILS_ABSOLUTE_DIR + image_name, 'wb')
-            img.write(urllib_request.urlopen(book.thumbnail_url).read())
-            book.image_name = image_name
 
         # preview url
         if update_preview_url and book.preview_url != update_preview_url:
@@ -249,6 +252,9 @@ def update_book():
 
         session.commit()
 
+        if new_thumbnail:
+            thumbnail_service.queue(book.id, book.thumbnail_url)
+
         flash("The book has been updated successfully!")
     except RuntimeError as rte:
         flash("Something has gone wrong! <br>%s" % str(rte), 'error')
@@ -257,6 +263,7 @@ def update_book():
 
 
 @mod.route('/view', methods=['GET'])
+@read_only
 def view_books(ready_books=None):
     """Display books in the library.
 
@@ -266,20 +273,6 @@ def view_books(ready_books=None):
     """
     session = db_session()
 
-    # get search cache
-    search_cache = []
-
-    for book_title in session.query(Book.title).distinct():
-        search_cache.append(book_title[0])
-
-    for category_name in session.query(Category.name).distinct():
-        search_cache.append(category_name[0])
-
-    for author_name in session.query(Author.name).distinct():
-        search_cache.append(author_name[0])
-
-    search_cache.sort()
-
     # initialise loan forms
     new_loan_form, loan_return_form = init_loan_forms()
 
@@ -294,38 +287,19 @@ def view_books(ready_books=None):
         books = ready_books
     # apply search criteria if provided
     elif search_term:
-        search_term = '%' + search_term.strip() + '%'
-        total = session.query(Book).\
-            join(Author.books).\
-            filter(or_(Book.title.ilike(search_term),
-                       Author.name.ilike(search_term))).\
-            union(
-                session.query(Book).
-                join(Category.books).
-                filter(or_(Book.title.ilike(search_term),
-                           Category.name.ilike(search_term)))
-            ).count()
-        books = session.query(Book).\
-            join(Author.books).\
-            filter(or_(Book.title.ilike(search_term),
-                       Author.name.ilike(search_term))).\
-            union(
-                session.query(Book).
-                join(Category.books).
-                filter(or_(Book.title.ilike(search_term),
-                           Category.name.ilike(search_term)))
-            ).order_by(Book.title).\
-            limit(PER_PAGE).offset((page - 1) * PER_PAGE)
+        total, books = search_books(session, search_term, page, PER_PAGE,
+                                    BOOK_LIST_OPTIONS)
     # include all books if specified
     elif include_unavailable:
-        total = session.query(Book.id).count()
-        books = session.query(Book).order_by(Book.title).\
-            limit(PER_PAGE).offset((page - 1) * PER_PAGE)
+        total, books = paginate_books('all',
+                                      session.query(Book),
+                                      page, PER_PAGE, BOOK_LIST_OPTIONS)
     # in all other cases, display all vailable books
     else:
-        total = session.query(Book).filter(Book.is_available == 1).count()
-        books = session.query(Book).filter(Book.is_available == 1).\
-            order_by(Book.title).limit(PER_PAGE).offset((page - 1) * PER_PAGE)
+        total, books = paginate_books('available',
+                                      session.query(Book).
+                                      filter(Book.is_available == 1),
+                                      page, PER_PAGE, BOOK_LIST_OPTIONS)
 
     pagination = Pagination(page=page,
                             total=total,
@@ -337,7 +311,6 @@ def view_books(ready_books=None):
                            new_loan_form=new_loan_form,
                            loan_return_form=loan_return_form,
                            pagination=pagination,
-                           search_cache=search_cache,
                            thumbnails_dir=THUMBNAILS_DIR)
 
 
@@ -352,130 +325,78 @@ def find_books():
     return redirect('books/view?q=' + search_term)
 
 
+@mod.route('/suggest', methods=['GET'])
+def suggest_terms():
+    """Suggest search terms starting with the `q` parameter.
+
+    Returns a JSON list of up to `SUGGEST_LIMIT` book titles, author names
+    and category names. The response carries an ETag of the catalogue
+    version, so clients revalidate cheaply until the catalogue changes.
+    """
+    prefix = request.args.get('q', '').strip()
+    version = refresh_term_index(db_session())
+
+    terms = []
+    if len(prefix) >= SUGGEST_MIN_LENGTH:
+        terms = term_index.lookup(prefix, SUGGEST_LIMIT)
+
+    response = jsonify(terms)
+    response.set_etag('catalogue-%d' % version)
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@mod.route('/covers/<name>', methods=['GET'])
+def cover(name):
+    """Serve a resized cover.
+
+    Cover names hold the hash of the original image, so a name never
+    changes content and browsers may keep it for good.
+    """
+    response = send_from_directory(thumbnail_service.derived_directory, name,
+                                   max_age=app.config['COVER_MAX_AGE'])
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
 @mod.route('/autoload', methods=['GET', 'POST'])
+@admin_access_required
 def auto_load_books():
     """Automated book loading.
 
-    Combining the lookup and add functions, this function aims at bulk
-    loading of books in the background.
+    Combining the lookup and add functions, this function starts the bulk
+    loading of books in the background and returns straight away. The
+    optional `n` argument limits the number of ISBNs looked up.
     """
-    session = db_session()
-    lookup_limit = request.args.get('n')
-
-    # lookup books
-    succeeded = []
-    failed = []
-    counter = 1
+    lookup_limit = request.values.get('n', type=int)
 
-    try:
-        for isbn in execute_sql('fetch_isbn', lookup_limit):
-            # ensure we don't exceed google or amazon api usage limit
-            if counter % 3 == 0:
-                sleep(random.uniform(60, 90))
-            else:
-                sleep(random.uniform(5, 10))
-            counter += 1
-
-            api_client = APIClient(isbn, None)
-            found_books = api_client.find_books(direct_search_only=True)
-
-            # to ensure only the right book is added, only search resulting
-            # yielding 1 result is accepted.
-            if len(found_books) != 1:
-                failed.append(
-                    (isbn[0], "search results %d" % len(found_books)))
-                continue
-
-            # now we add the book.
-            book = found_books[0]
-
-            # defaults
-            book.is_available = True
-            book.current_location = BookLocation.LIBRARY.value
-
-            if book.thumbnail_url:
-                image_name = ''.join(
-                    [c for c in book.title.replace(' ', '_')
-                     if re.match(r'\w', c)]) + book.isbn13 + '.jpg'
-                img = open(THUMBNAILS_ABSOLUTE_DIR + image_name, 'wb')
-                img.write(urllib_request.urlopen(book.thumbnail_url).read())
-                book.image_name = image_name
-
-            for i in range(len(book.authors)):
-                lookup_author = Author.query.filter(
-                    Author.name == book.authors[i].name).first()
-                if lookup_author:
-                    book.authors[i] = None
-                    book.authors[i] = lookup_author
-
-            for i in range(len(book.categories)):
-                lookup_category = Category.query.filter(
-                    Category.name == book.categories[i].name).first()
-                if lookup_category:
-                    book.categories[i] = None
-                    book.categories[i] = lookup_category
-
-            session.add(book)
-            session.commit()
-            succeeded.append(isbn[0])
-
-        execute_sql('update_success', succeeded=succeeded)
-        execute_sql('update_failed', failed=failed)
-
-    except RuntimeError as rt_error:
-        flash("Something has gone wrong! " + str(rt_error))
-
-    flash('success: ' + ','.join(str(i) for i in succeeded))
-    flash('failed: ' + ','.join(str(i) for i, e in failed))
+    if autoload_job.start(lookup_limit):
+        flash('Book loading has started.')
+    else:
+        flash('Book loading is already running.', 'error')
     return redirect('books/view')
 
 
-def execute_sql(action, lookup_limit=10, failed=None, succeeded=None):
-    """Execute sql to fetch isbns to lookup or update lookup status."""
-    # update the lookup table
-    connection = sqlite3.connect(
-        app.config['DATABASE_URI'].replace('sqlite:///', ''))
-    cursor = connection.cursor()
-    sql = ""
-    if action == 'fetch_isbn':
-        sql = """
-            SELECT DISTINCT isbn
-            FROM isbn_lookup
-            WHERE status IS NULL
-            OR status NOT LIKE '%SUCCESS%'
-            ORDER BY last_check
-            LIMIT {0};
-            """.format(int(lookup_limit))
-        cursor.execute(sql)
-        return cursor.fetchall()
-
-    if action == 'update_success':
-        assert (succeeded is not None), "Succeeded list is None."
-        sql = """
-            UPDATE isbn_lookup
-            SET
-                status = 'SUCCESS_DIRECT',
-                last_check = CURRENT_TIMESTAMP
-            WHERE isbn in ('{0}');
-            """.format("','".join(str(i) for i in succeeded))
-        cursor.execute(sql)
-        connection.commit()
-
-    if action == 'update_failed':
-        # assert (failed is not None), "Failed list is None."
-        # assert (failed), "Failed list is empty."
-        if failed:
-            sql = """
-                UPDATE isbn_lookup
-                    SET errors = (CASE isbn """
-            for isbn, error in failed:
-                sql += " WHEN '%s' THEN errors + '|%s' " % (isbn, error)
-            sql += """ ELSE errors END),
-                last_check = CURRENT_TIMESTAMP,
-                status = 'FAILED_DIRECT'
-                WHERE isbn IN ('%s');""" % "','".join(
-                    [str(i) for i, e in failed])
-            cursor.execute(sql)
-            connection.commit()
-
-    connection.close()
+@mod.route('/autoload/status', methods=['GET'])
+@admin_access_required
+def auto_load_status():
+    """Show the progress and throughput of the book loading job."""
+    return jsonify(autoload_job.status())
+
+
+@mod.route('/autoload/pause', methods=['POST'])
+@admin_access_required
+def auto_load_pause():
+    """Pause the book loading job."""
+    autoload_job.pause()
+    return jsonify(autoload_job.status())
+
+
+@mod.route('/autoload/resume', methods=['POST'])
+@admin_access_required
+def auto_load_resume():
+    """Resume the paused book loading job."""
+    autoload_job.resume()
+    return jsonify(autoload_job.status())
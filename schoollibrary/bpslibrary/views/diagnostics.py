@@ -0,0 +1,54 @@
+"""
+Diagnostics
+===========
+
+A view exposing the effective runtime settings of the system.
+"""
+
+from flask import Blueprint, jsonify
+from bpslibrary.database import RoutingSession, engine, get_db_diagnostics
+from bpslibrary.utils.barcode import stage_timings
+from bpslibrary.utils.decoding import decoding_service
+from bpslibrary.utils.identity import identity_cache
+from bpslibrary.utils.lookupcache import lookup_cache
+from bpslibrary.utils.permission import admin_access_required
+
+
+mod = Blueprint('diagnostics', __name__, url_prefix='/diagnostics')
+
+
+@mod.route('/database', methods=['GET'])
+@admin_access_required
+def database():
+    """Show the database engines, pools and sqlite pragma settings."""
+    diagnostics = get_db_diagnostics(engine)
+    diagnostics['read_engines'] = [get_db_diagnostics(read_engine)
+                                   for read_engine
+                                   in RoutingSession.read_engines]
+    return jsonify(diagnostics)
+
+
+@mod.route('/lookup-cache', methods=['GET'])
+@admin_access_required
+def lookup_cache_stats():
+    """Show the hit and miss counts of the provider lookup cache."""
+    return jsonify(path=lookup_cache.path,
+                   ttl=lookup_cache.ttl,
+                   negative_ttl=lookup_cache.negative_ttl,
+                   max_bytes=lookup_cache.max_bytes,
+                   stats=dict(lookup_cache.stats))
+
+
+@mod.route('/barcode', methods=['GET'])
+@admin_access_required
+def barcode_timings():
+    """Show the decoding queue and the time spent scanning barcodes."""
+    return jsonify(decoding=decoding_service.metrics(),
+                   stages=stage_timings.summary())
+
+
+@mod.route('/identity-cache', methods=['GET'])
+@admin_access_required
+def identity_cache_stats():
+    """Show the hit and miss counts of the logged in users cache."""
+    return jsonify(ttl=identity_cache.ttl, stats=dict(identity_cache.stats))
@@ -9,14 +9,18 @@ from flask import Blueprint, flash, render_template, request
 from flask_login import login_required, current_user
 from flask_paginate import Pagination, get_page_parameter
 from sqlalchemy import and_
+from sqlalchemy.orm import joinedload
 from werkzeug.utils import secure_filename
 from bpslibrary import app
-from bpslibrary.database import db_session
-from bpslibrary.models import Book, Classroom, Pupil, User, Loan
+from bpslibrary.database import db_session, read_only
+from bpslibrary.models import Book, Pupil, Loan, BOOK_LIST_OPTIONS
 from bpslibrary.utils.nav import redirect_to_previous
-from bpslibrary.utils.barcode import scan_for_isbn
-from bpslibrary.forms import NewLoanForm, LoanReturnForm
+from bpslibrary.utils.decoding import decoding_service
+from bpslibrary.forms import BulkReturnForm, NewLoanForm, LoanReturnForm
 from bpslibrary.utils.enums import BookLocation
+from bpslibrary.utils.identity import identity_cache
+from bpslibrary.utils.isbnkeys import resolve_isbns
+from bpslibrary.utils.loanqueries import page_books_on_loan
 
 
 mod = Blueprint('loans', __name__, url_prefix='/loans')
@@ -24,6 +28,38 @@ THUMBNAILS_DIR = app.config['THUMBNAILS_DIR']
 PER_PAGE = app.config['PER_PAGE']
 
 
+def scanned_book(session, isbnlist, book_id=None):
+    """Return the book of the ISBNs scanned from a barcode.
+
+    If `book_id` is given, the barcode must be of that book; otherwise the
+    book is found from the barcode alone.
+
+    Raises ValueError if no single book matches.
+    """
+    if len(isbnlist) < 1:
+        raise ValueError("No ISBN found in provided image.")
+
+    books = {book.id: book
+             for book in resolve_isbns(session, isbnlist).values()}
+
+    if book_id:
+        book = books.get(int(book_id))
+        if not book:
+            if not session.query(Book.id).filter(Book.id == int(book_id)).\
+                    first():
+                raise ValueError("Invalid entries!")
+            raise ValueError("Barcode does not match selected book.")
+        return book
+
+    if not books:
+        raise ValueError("No library book found for ISBN %s." %
+                         ', '.join(isbnlist))
+    if len(books) > 1:
+        raise ValueError("The barcode matches several books, please "
+                         "record this one from its page.")
+    return next(iter(books.values()))
+
+
 @mod.route('/record', methods=['POST'])
 @login_required
 def record_loan():
@@ -31,50 +67,44 @@ def record_loan():
     session = db_session()
     new_loan_form = NewLoanForm()
 
-    class_id = current_user.classroom.id
-    new_loan_form.pupil_id.choices = \
-        [(p[0], p[1]) for p in session.query(Pupil.id, Pupil.name).
-         filter(Pupil.classroom_id == class_id)]
     try:
-        user = User.query.filter(
-            User.id == int(new_loan_form.user_id.data)
-            ).first()
-        pupil = Pupil.query.filter(
-            Pupil.id == int(new_loan_form.pupil_id.data)
-            ).first()
-        book = Book.query.filter(
-            Book.id == int(new_loan_form.book_id.data)
-            ).first()
-
-        if not user or not pupil or not book:
-            raise ValueError(
-                "Invalid entries! Book: %s; Pupil: %s; User: %s" %
-                (str(book), str(pupil), str(user))
-            )
-
         if not new_loan_form.barcode_img.data:
             raise ValueError(
                 "No barcode image provided. Please scan the barcode."
             )
 
-        isbnlist = scan_for_isbn(request.files[new_loan_form.barcode_img.name])
+        # end the transaction the user was loaded in, so no connection
+        # is held while the photo is decoded
+        session.rollback()
+        isbnlist = decoding_service.scan_for_isbn(
+            request.files[new_loan_form.barcode_img.name])
 
-        if len(isbnlist) < 1:
-            raise ValueError(
-                "No ISBN found in provided image."
-            )
+        new_loan_form.pupil_id.choices = list(current_user.pupil_choices)
 
-        if book.isbn13 not in isbnlist:
+        user = identity_cache.get(session, int(new_loan_form.user_id.data))
+        pupil = Pupil.query.filter(
+            Pupil.id == int(new_loan_form.pupil_id.data)
+            ).first()
+
+        if not user or not pupil:
             raise ValueError(
-                "Barcode does not match selected book."
+                "Invalid entries! Pupil: %s; User: %s" %
+                (str(pupil), str(user))
             )
 
+        book = scanned_book(session, isbnlist, new_loan_form.book_id.data)
+
+        if book.open_loan:
+            raise ValueError("'%s' is already on loan." % book.title)
+
         loan = Loan()
         loan.pupil = pupil
         loan.book = book
         loan.start_date = datetime.date(datetime.now())
 
         book.current_location = BookLocation.LOAN.value
+        book.open_loan = loan
+        book.current_pupil = pupil
 
         session.add(loan)
         session.commit()
@@ -95,25 +125,16 @@ def record_return():
     loan_return_form = LoanReturnForm()
 
     try:
-        book = Book.query.filter(
-            Book.id == int(loan_return_form.book_id.data)
-            ).first()
-
-        if not book:
-            raise ValueError("Invalid entries!")
-
         if not loan_return_form.barcode_img.data:
             raise ValueError(
                 "No barcode image provided. Please scan the barcode.")
 
-        isbnlist = scan_for_isbn(
+        # decode without holding a connection, see record_loan
+        session.rollback()
+        isbnlist = decoding_service.scan_for_isbn(
             request.files[loan_return_form.barcode_img.name])
 
-        if len(isbnlist) < 1:
-            raise ValueError("No ISBN found in provided image.")
-
-        if book.isbn13 not in isbnlist:
-            raise ValueError("Barcode does not match selected book.")
+        book = scanned_book(session, isbnlist, loan_return_form.book_id.data)
 
         loan = book.current_loan
 
@@ -122,6 +143,8 @@ def record_return():
 
         loan.end_date = datetime.date(datetime.now())
         book.current_location = BookLocation.LIBRARY.value
+        book.open_loan = None
+        book.current_pupil = None
 
         session.commit()
         flash("Book return has been recorded for '%s' by %s" %
@@ -132,23 +155,81 @@ def record_return():
     return redirect_to_previous(True)
 
 
+@mod.route('/return/bulk', methods=['GET', 'POST'])
+@login_required
+def record_bulk_return():
+    """Records return of the books in several barcode images.
+
+    The images are decoded in parallel, the books of all ISBNs found are
+    fetched with one query, and their open loans are closed in a single
+    transaction. A report of every ISBN is rendered.
+    """
+    session = db_session()
+    bulk_return_form = BulkReturnForm()
+
+    if request.method == 'GET' or not bulk_return_form.validate():
+        for error in bulk_return_form.barcode_imgs.errors:
+            flash(error, 'error')
+        return render_template('bulk_return.html',
+                               bulk_return_form=bulk_return_form)
+
+    report = []
+    # no connection is held while the photos are decoded, see record_loan
+    session.rollback()
+    isbns = []
+    for image, (found, error) in zip(
+            bulk_return_form.barcode_imgs.data,
+            decoding_service.scan_many(
+                bulk_return_form.barcode_imgs.data,
+                app.config['BARCODE_BULK_MAX_LENGTH'])):
+        if error:
+            report.append((image.filename, None, error))
+        elif not found:
+            report.append((image.filename, None, "No ISBN found in image."))
+        isbns += [isbn for isbn in found if isbn not in isbns]
+
+    books = resolve_isbns(
+        session, isbns,
+        (joinedload(Book.open_loan).joinedload(Loan.pupil),))
+    today = datetime.date(datetime.now())
+    returned = 0
+    for isbn in isbns:
+        book = books.get(isbn)
+        if not book:
+            report.append((isbn, None, "Not a library book."))
+        elif not book.open_loan:
+            report.append((isbn, book.title, "Not on loan."))
+        else:
+            book.open_loan.end_date = today
+            report.append((isbn, book.title, "Returned by %s." %
+                           book.open_loan.pupil.name))
+            book.current_location = BookLocation.LIBRARY.value
+            book.open_loan = None
+            book.current_pupil = None
+            returned += 1
+
+    session.commit()
+    flash("%d book(s) returned." % returned)
+
+    return render_template('bulk_return.html',
+                           bulk_return_form=bulk_return_form,
+                           report=report)
+
+
 @mod.route('/view', methods=['GET'])
 @login_required
+@read_only
 def view_loans():
     """Displays loans of a book, or of all books."""
     session = db_session()
-    if current_user.is_admin:
-        found_books = session.query(Book).filter(
-            Book.current_location == BookLocation.LOAN.value).all()
-    else:
-        found_books = session.query(Book).filter(
-            Book.current_location == BookLocation.LOAN.value and
-            Book.id in [l.book_id for l in Classroom.query(
-                Classroom.user_id == current_user.id).open_loans]).all()
+    page = request.args.get(get_page_parameter(), type=int, default=1)
+
+    total, found_books = page_books_on_loan(
+        session,
+        None if current_user.is_admin else current_user,
+        page, PER_PAGE, BOOK_LIST_OPTIONS)
 
     # pagination
-    total = len(found_books)
-    page = request.args.get(get_page_parameter(), type=int, default=1)
     pagination = Pagination(page=page,
                             total=total,
                             per_page=PER_PAGE,
@@ -167,8 +248,6 @@ def view_loans():
 
 def init_loan_forms():
     """Initialise a new_loan and loan_return forms."""
-    session = db_session()
-
     new_loan_form = None
     loan_return_form = None
 
@@ -176,9 +255,6 @@ def init_loan_forms():
         loan_return_form = LoanReturnForm()
         if current_user.classroom:
             new_loan_form = NewLoanForm()
-            class_id = current_user.classroom.id
-            new_loan_form.pupil_id.choices = \
-                [(p[0], p[1]) for p in session.query(Pupil.id, Pupil.name).
-                 filter(Pupil.classroom_id == class_id)]
+            new_loan_form.pupil_id.choices = list(current_user.pupil_choices)
 
     return new_loan_form, loan_return_form
@@ -7,16 +7,21 @@ It includes user and access management functions.
 # pylint: disable=E1101
 
 
-import csv
+import math
 import os
 from flask import Blueprint, flash, redirect, render_template, request
 from flask_login import login_user, logout_user, current_user
+from markupsafe import escape
+from sqlalchemy import func
 from werkzeug.utils import secure_filename
 from bpslibrary.database import db_session
-from bpslibrary.models import Classroom, Pupil, User
+from bpslibrary.models import Classroom, User
 from bpslibrary.forms import LoginForm, NewAccessForm
+from bpslibrary.utils.identity import identity_cache
 from bpslibrary.utils.nav import redirect_to_previous
+from bpslibrary.utils.passwords import login_failed, login_wait
 from bpslibrary.utils.permission import admin_access_required
+from bpslibrary.utils.roster import import_roster
 
 
 UPLOAD_DIR = '/tmp/'
@@ -66,7 +71,8 @@ def update_classroom():
                 file_path = os.path.join(UPLOAD_DIR, filename)
                 classroom_file.save(file_path)
 
-                if update_db(file_path):
+                if update_db(file_path,
+                             bool(request.form.get('replace_roster'))):
                     flash("Classroom details have been updated successfully!")
 
         except (FileNotFoundError, ValueError) as error:
@@ -75,27 +81,32 @@ def update_classroom():
         return redirect('users/update')
 
 
-def update_db(classroom_file):
-    """Persist the the details in the file into the database."""
+def update_db(classroom_file, replace=False):
+    """Persist the the details in the file into the database.
+
+    Rows that cannot be imported are reported and skipped. If `replace`
+    is set, pupils missing from the file are taken off their classrooms.
+    """
     try:
         session = db_session()
-        with open(classroom_file) as csv_file:
-            reader = csv.reader(csv_file, delimiter=',', quotechar='"')
-
-            current_classroom = None
-
-            for row in reader:
-                if not current_classroom or \
-                   not row[0] == current_classroom.name:
-                    current_classroom = Classroom(row[0])
-                    current_classroom.year = row[1]
-                    session.add(current_classroom)
-                current_classroom.pupils.append(Pupil(row[2]))
-
-            session.commit()
-            return True
+        with open(classroom_file, newline='') as csv_file:
+            report = import_roster(session, csv_file, replace)
+        identity_cache.clear()
+
+        if report.errors:
+            flash("%d row(s) could not be imported:<br>%s" % (
+                len(report.errors),
+                # the messages quote the file, flashes are shown as markup
+                '<br>'.join('Line %d: %s' % (line_number, escape(message))
+                            for line_number, message in report.errors)),
+                  'error')
+        flash("%d classroom(s) and %d pupil(s) added, %d pupil(s) removed." %
+              (report.classrooms_added,
+               report.pupils_added,
+               report.pupils_removed))
+        return True
     except Exception as err:  # pylint: disable=W0703
-        flash("Something has gone wrong!<br>" + str(err), 'error')
+        flash("Something has gone wrong!<br>" + escape(str(err)), 'error')
     return False
 
 
@@ -110,13 +121,32 @@ def login():
 
     if request.method == 'POST':
         if login_form.validate_on_submit():
-            user = User.query.filter(User.username.ilike(
-                login_form.username.data.lower())).first()
+            # attempts are limited before any password is checked, and
+            # only wrong passwords count against the user
+            wait = login_wait(request.remote_addr)
+            user = None
+            if not wait:
+                user = User.query.filter(
+                    func.lower(User.username) ==
+                    login_form.username.data.lower()).first()
+                if user:
+                    wait = login_wait(request.remote_addr, user.username)
+
+            if wait:
+                flash("Too many login attempts, please try again in %d "
+                      "seconds." % math.ceil(wait), 'error')
+                return render_template('access.html',
+                                       login_form=login_form), 429
 
             if user and user.is_correct_password(login_form.password.data):
+                if user.password_needs_rehash:
+                    user.password = login_form.password.data
+                    db_session.commit()
                 login_user(user)
                 flash("Logged in successfully!")
                 return redirect_to_previous()
+            if user:
+                login_failed(user.username)
 
         flash("Invalid login details.", 'error')
 
@@ -151,7 +181,8 @@ def add_user():
         if new_access_form.validate_on_submit():
             # check if it's an existing user
             user = User.query.filter(
-                User.username.ilike(new_access_form.username.data)).first()
+                func.lower(User.username) ==
+                new_access_form.username.data.lower()).first()
             # check if a classroom id has been passed
             classroom = Classroom.query.filter(
                 Classroom.id == new_access_form.classroom.data).first()
@@ -167,6 +198,7 @@ def add_user():
                 user.password = new_access_form.password.data
                 user.is_admin = new_access_form.is_admin.data
                 session.commit()
+                identity_cache.clear()
                 flash("Login details have been updated!")
 
             # for new users, create
@@ -182,6 +214,7 @@ def add_user():
 
                 session.add(user)
                 session.commit()
+                identity_cache.clear()
                 flash("Access has been created successfully!")
         else:
             flash("Invalid entries!", 'error')
@@ -14,18 +14,118 @@ SECRET_KEY = 'dev'
 DATABASE_URI = 'sqlite:///' + os.path.join(BASE_DIR,
                                            'bpslibrary/bpslibrary.db')
 DATABASE_CONNECT_OPTIONS = {}
+DATABASE_ECHO = False
+# pool class name from sqlalchemy.pool (e.g. 'QueuePool', 'NullPool'),
+# None for the dialect default; size and overflow apply to QueuePool only
+DATABASE_POOL_CLASS = None
+DATABASE_POOL_SIZE = 5
+DATABASE_POOL_MAX_OVERFLOW = 10
+DATABASE_POOL_RECYCLE = -1
+# read engines (e.g. a replica file or a second dsn) for read-only views,
+# and seconds after a write during which a user session reads the primary
+DATABASE_READ_URIS = []
+DATABASE_STICKY_SECONDS = 10
+# applied to every new sqlite connection
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,           # negative values are in KiB
+    'mmap_size': 64 * 1024 * 1024,  # bytes
+    'busy_timeout': 5000,           # milliseconds
+}
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
-# password hashing
+# password hashing: the bcrypt cost is calibrated so a hash takes about
+# BCRYPT_TARGET_SECONDS on the host, see bpslibrary.utils.passwords; with
+# no target, BCRYPT_LOG_ROUNDS is used
 BCRYPT_LOG_ROUNDS = 12
+BCRYPT_TARGET_SECONDS = 0.25
+BCRYPT_MIN_ROUNDS = 10
+BCRYPT_MAX_ROUNDS = 14
+# passwords checked at a time by each process
+PASSWORD_WORKERS = 2
+# token bucket limits of login attempts per client address and of wrong
+# passwords per user, kept by each process for the keys used last
+LOGIN_IP_RATE = 1                   # attempts per second
+LOGIN_IP_BURST = 30
+LOGIN_USER_RATE = 1 / 30            # attempts per second
+LOGIN_USER_BURST = 5
+LOGIN_THROTTLE_MAX_KEYS = 10000
 
 # pagination
 PER_PAGE = 15
+KEYSET_PAGINATION = True
+PAGINATION_CACHE_TTL = 60
+# listings (each search term is one) whose counts and pages are kept
+PAGINATION_CACHE_MAX_LISTINGS = 200
+
+# search box suggestions
+SUGGEST_LIMIT = 10
+SUGGEST_MIN_LENGTH = 3
 
 # thumbnails
 THUMBNAILS_ABSOLUTE_DIR = os.path.join(BASE_DIR,
                                        'bpslibrary/static/img/thumbnails/')
 THUMBNAILS_DIR = 'img/thumbnails/'
+# barcode decoding processes, the most photos queued or decoding at a
+# time (more are turned away as busy) and the seconds allowed per photo
+BARCODE_WORKERS = 2
+BARCODE_QUEUE_SIZE = 8
+BARCODE_DEADLINE = 10
+# the longest side in pixels photos of several barcodes are scanned at,
+# and the most photos returned at once
+BARCODE_BULK_MAX_LENGTH = 2400
+BARCODE_BULK_MAX_FILES = 20
+
+# concurrent cover downloads, see bpslibrary.utils.thumbnails
+THUMBNAIL_WORKERS = 2
+# widths in pixels of the resized covers, and how long browsers keep them
+THUMBNAIL_WIDTHS = (96, 192)
+COVER_MAX_AGE = 365 * 24 * 3600     # seconds
+
+# external apis http settings
+HTTP_TIMEOUT = (3.05, 10)           # connect, read seconds
+HTTP_RETRIES = 2
+HTTP_BACKOFF_FACTOR = 0.5           # seconds, doubled on each retry
+HTTP_MAX_CONNECTIONS_PER_HOST = 4
+# threads running concurrent book lookups, shared by all requests
+LOOKUP_MAX_WORKERS = 8
+# token bucket rate limit of calls per host, shared by all workers through
+# the lock files in RATE_LIMIT_DIR; a rate of None is unlimited
+HTTP_RATE_LIMIT = 5                 # calls per second
+HTTP_RATE_BURST = 5                 # calls back to back
+RATE_LIMIT_DIR = os.path.join(BASE_DIR, 'bpslibrary/ratelimit/')
+# seconds the lookup page waits for a token; providers further off, such
+# as ebay once its burst is spent, are skipped. background loading waits.
+HTTP_RATE_MAX_WAIT = 5
+# per provider host overrides of the settings above
+HTTP_PROVIDER_SETTINGS = {
+    'www.googleapis.com': {'rate': 1, 'burst': 5},
+    'xisbn.worldcat.org': {'timeout': (3.05, 5)},
+    'www.librarything.com': {'timeout': (3.05, 5)},
+    'svcs.ebay.com': {'timeout': (3.05, 5), 'rate': 0.05, 'burst': 10},
+    'webservices.amazon.co.uk': {'timeout': (3.05, 10),
+                                 'rate': 1, 'burst': 1},
+}
+
+# request only the fields used of google books responses, and search up
+# to GOOGLE_BOOKS_BATCH_SIZE isbns per request when looking up several
+GOOGLE_BOOKS_PROJECTION = True
+GOOGLE_BOOKS_BATCH_SIZE = 10
+
+# background book loading, see bpslibrary.utils.autoload
+AUTOLOAD_STATE_PATH = os.path.join(BASE_DIR, 'bpslibrary/autoload.json')
+AUTOLOAD_BATCH_SIZE = 20
+
+# cache of the external apis responses
+LOOKUP_CACHE_PATH = os.path.join(BASE_DIR, 'bpslibrary/lookup_cache.db')
+LOOKUP_CACHE_TTL = 30 * 24 * 3600           # seconds
+LOOKUP_CACHE_NEGATIVE_TTL = 24 * 3600       # seconds
+LOOKUP_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# seconds logged in users, their classrooms and pupils are kept in the
+# cache of every process, see bpslibrary.utils.identity
+IDENTITY_CACHE_TTL = 60
 
 # api keys
 AWS_ACCESS_KEY = 'dev'
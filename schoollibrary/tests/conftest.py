@@ -0,0 +1,137 @@
+"""Test fixtures: the application running on an empty temporary database.
+
+The configuration module is loaded from the project and pointed at a
+temporary directory before `bpslibrary` is imported, so the tests never
+touch the library database or the caches next to it.
+"""
+
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+from datetime import date
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DIR = tempfile.mkdtemp(prefix='bpslibrary-tests-')
+
+
+def _load_config():
+    """Return the project configuration, writing into TEST_DIR."""
+    spec = importlib.util.spec_from_file_location(
+        'bpslibrary_config', os.path.join(ROOT, 'bpslibrary_config.py'))
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+
+    config.TESTING = True
+    config.WTF_CSRF_ENABLED = False
+    config.DATABASE_URI = 'sqlite:///' + os.path.join(TEST_DIR, 'test.db')
+    config.DATABASE_READ_URIS = []
+    config.LOOKUP_CACHE_PATH = os.path.join(TEST_DIR, 'lookup_cache.db')
+    config.RATE_LIMIT_DIR = os.path.join(TEST_DIR, 'ratelimit/')
+    config.AUTOLOAD_STATE_PATH = os.path.join(TEST_DIR, 'autoload.json')
+    config.THUMBNAILS_ABSOLUTE_DIR = os.path.join(TEST_DIR, 'thumbnails')
+    # cheap hashes, no calibration
+    config.BCRYPT_TARGET_SECONDS = None
+    config.BCRYPT_LOG_ROUNDS = 4
+    return config
+
+
+sys.path.insert(0, ROOT)
+sys.modules['bpslibrary_config'] = _load_config()
+
+# pylint: disable=C0413
+from bpslibrary import app as bps_app  # noqa: E402
+from bpslibrary.database import db_session, engine  # noqa: E402
+from bpslibrary.models import (Author, Book, Category, Classroom,  # noqa
+                               Loan, Model, Pupil, User)
+from bpslibrary.utils.enums import BookLocation  # noqa: E402
+from bpslibrary.utils.identity import identity_cache  # noqa: E402
+from bpslibrary.utils.pagination import listing_cache  # noqa: E402
+
+
+def pytest_sessionfinish(session, exitstatus):
+    """Remove the temporary directory."""
+    shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+
+@pytest.fixture
+def app():
+    """The application."""
+    return bps_app
+
+
+@pytest.fixture
+def client(app):
+    """A test client of the application."""
+    return app.test_client()
+
+
+@pytest.fixture
+def session():
+    """A database session; every table is emptied afterwards."""
+    yield db_session()
+    db_session.remove()
+    with engine.begin() as connection:
+        for table in reversed(Model.metadata.sorted_tables):
+            if table.name != 'catalogue_version':
+                connection.execute(table.delete())
+        connection.execute('DELETE FROM books_fts')
+    listing_cache.clear()
+    identity_cache.clear()
+
+
+def make_book(session, title, authors=(), categories=()):
+    """Add an available book with the given author and category names."""
+    book = Book()
+    book.title = title
+    book.description = 'About ' + title
+    book.is_available = True
+    book.current_location = BookLocation.LIBRARY.value
+    book.authors = [Author(name) for name in authors]
+    book.categories = [Category(name) for name in categories]
+    session.add(book)
+    return book
+
+
+def lend(session, book, pupil, start=None):
+    """Record the loan of `book` to `pupil` as the loan view does."""
+    loan = Loan()
+    loan.book = book
+    loan.pupil = pupil
+    loan.start_date = start or date.today()
+    book.current_location = BookLocation.LOAN.value
+    book.open_loan = loan
+    book.current_pupil = pupil
+    session.add(loan)
+    return loan
+
+
+def give_back(book, end=None):
+    """Record the return of `book` as the return view does."""
+    book.open_loan.end_date = end or date.today()
+    book.current_location = BookLocation.LIBRARY.value
+    book.open_loan = None
+    book.current_pupil = None
+
+
+def make_classroom_user(session, name='Class 1', pupils=('Pupil 1',)):
+    """Add a classroom with its pupils and login user."""
+    user = User()
+    user.username = name.lower().replace(' ', '')
+    user.password = 'secret'
+    user.is_admin = False
+    classroom = Classroom(name)
+    classroom.year = 1
+    classroom.user = user
+    classroom.pupils = [Pupil(p) for p in pupils]
+    session.add(classroom)
+    return user, classroom
+
+
+def login(client, user_id):
+    """Log the user `user_id` in on `client`."""
+    with client.session_transaction() as flask_session:
+        flask_session['_user_id'] = str(user_id)
+        flask_session['_fresh'] = True
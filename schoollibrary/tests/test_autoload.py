@@ -0,0 +1,36 @@
+"""The autoload job starts once and tries every ISBN once."""
+
+import os
+from bpslibrary.database import engine
+from bpslibrary.models import IsbnLookup
+from bpslibrary.utils.autoload import (AutoloadJob, check_time, fetch_isbns,
+                                       record_results)
+from conftest import TEST_DIR
+
+
+def test_only_one_start_succeeds(monkeypatch):
+    """A second start sees the first in the state file."""
+    job = AutoloadJob(os.path.join(TEST_DIR, 'start-once.json'), 5)
+    monkeypatch.setattr(job, '_run', lambda limit: None)
+    assert job.start()
+    assert not job.start()
+    assert job._update(lambda state: False, paused=True) is None
+    assert not job._read()['paused']
+
+
+def test_isbns_checked_since_the_start_are_left_out(session):
+    """Failed ISBNs are not taken again by the same job."""
+    with engine.begin() as connection:
+        connection.execute(IsbnLookup.__table__.insert(),
+                           [{'isbn': '97800000000%02d' % i, 'status': None}
+                            for i in range(6)])
+    job_started = check_time()
+
+    first = fetch_isbns(4, job_started)
+    assert len(first) == 4
+    record_results(first[:1], [(isbn, 'search results 0')
+                               for isbn in first[1:]])
+
+    rest = fetch_isbns(4, job_started)
+    assert len(rest) == 2 and not set(rest) & set(first)
+    assert len(fetch_isbns(10)) == 5
@@ -0,0 +1,74 @@
+"""The decoding pool recovers from dead processes and feeds on batches.
+
+The processes are forked from the test process, as a fork server would
+import the project configuration and its database.
+"""
+
+import io
+import time
+import pytest
+from bpslibrary.utils import decoding
+from bpslibrary.utils.decoding import DecodingService
+from conftest import login, make_classroom_user
+
+
+def slow_decode(data, max_length):
+    """A decode that is killed before it is done."""
+    time.sleep(30)
+
+
+def quick_decode(data, max_length):
+    """A decode that finds nothing."""
+    return [], {}
+
+
+def isbn_decode(data, max_length):
+    """A decode finding the ISBN the photo is named for, after a while."""
+    time.sleep(0.05)
+    return [data.decode('ascii')], {}
+
+
+def test_broken_pool_is_restarted(monkeypatch):
+    """The photo of the dead process fails, the next one is decoded."""
+    monkeypatch.setattr(decoding, 'START_METHOD', 'fork')
+    monkeypatch.setattr(decoding, 'decode', slow_decode)
+    service = DecodingService(1, 2, 10)
+
+    submitted = service.submit(io.BytesIO(b'photo'))
+    for process in list(service._executor._processes.values()):
+        process.kill()
+    with pytest.raises(ValueError, match='stopped'):
+        service.result(*submitted)
+
+    monkeypatch.setattr(decoding, 'decode', quick_decode)
+    assert service.scan_for_isbn(io.BytesIO(b'photo')) == []
+    assert service.metrics()['restarts'] == 1
+    service._executor.shutdown()
+
+
+def test_batches_larger_than_the_queue_are_decoded(monkeypatch):
+    """Photos past the queue size wait for room rather than fail."""
+    monkeypatch.setattr(decoding, 'START_METHOD', 'fork')
+    monkeypatch.setattr(decoding, 'decode', isbn_decode)
+    service = DecodingService(2, 3, 10)
+
+    photos = [io.BytesIO(b'%013d' % i) for i in range(12)]
+    results = service.scan_many(photos)
+    assert results == [(['%013d' % i], None) for i in range(12)]
+    assert service.metrics()['rejected'] == 0
+    service._executor.shutdown()
+
+
+def test_bulk_return_caps_the_photos(app, client, session, monkeypatch):
+    """Uploads of more photos than the cap are refused before decoding."""
+    user, _ = make_classroom_user(session)
+    session.commit()
+    login(client, user.id)
+    monkeypatch.setattr(decoding.decoding_service, 'scan_many', None)
+
+    cap = app.config['BARCODE_BULK_MAX_FILES']
+    response = client.post('/loans/return/bulk', data={
+        'barcode_imgs': [(io.BytesIO(b'photo'), 'photo%d.jpg' % i)
+                         for i in range(cap + 1)]})
+    assert response.status_code == 200
+    assert 'at most %d pictures' % cap in response.get_data(as_text=True)
@@ -0,0 +1,78 @@
+"""The number of queries of the book listings does not grow with the page.
+"""
+
+from contextlib import contextmanager
+import pytest
+from sqlalchemy import event
+from bpslibrary.database import engine
+from bpslibrary.utils.pagination import listing_cache
+from bpslibrary.views import books as books_view
+from bpslibrary.views import loans as loans_view
+from conftest import lend, login, make_book, make_classroom_user
+
+
+@contextmanager
+def count_queries():
+    """Count the statements executed, in `counter[0]`."""
+    counter = [0]
+
+    def count(*args):
+        """Count one statement."""
+        counter[0] += 1
+
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+
+
+@pytest.fixture
+def library(session):
+    """Return a classroom user id; add 40 books, half of them on loan."""
+    user, classroom = make_classroom_user(
+        session, pupils=['Pupil %d' % i for i in range(4)])
+    for i in range(40):
+        book = make_book(session, 'Book %02d' % i,
+                         authors=['Author %d-a' % i, 'Author %d-b' % i],
+                         categories=['Category %d-a' % i,
+                                     'Category %d-b' % i])
+        if i % 2:
+            lend(session, book, classroom.pupils[i % 4])
+    session.commit()
+    return user.id
+
+
+def page_queries(client, monkeypatch, module, url, per_page):
+    """Return the statements of rendering `url` at `per_page` books."""
+    monkeypatch.setattr(module, 'PER_PAGE', per_page)
+    listing_cache.clear()
+    with count_queries() as counter:
+        response = client.get(url)
+    assert response.status_code == 200
+    return counter[0]
+
+
+@pytest.mark.parametrize('url', ['/books/view',
+                                 '/books/view?include-unavailable=1',
+                                 '/books/view?q=book'])
+def test_book_listing_queries_do_not_depend_on_page_size(
+        client, monkeypatch, library, url):
+    """The books listing runs as many queries for 5 books as for 20."""
+    login(client, library)
+    client.get(url)
+
+    small = page_queries(client, monkeypatch, books_view, url, 5)
+    large = page_queries(client, monkeypatch, books_view, url, 20)
+    assert small == large
+
+
+def test_loans_listing_queries_do_not_depend_on_page_size(
+        client, monkeypatch, library):
+    """The loans listing runs as many queries for 5 books as for 20."""
+    login(client, library)
+    client.get('/loans/view')
+
+    small = page_queries(client, monkeypatch, loans_view, '/loans/view', 5)
+    large = page_queries(client, monkeypatch, loans_view, '/loans/view', 20)
+    assert small == large
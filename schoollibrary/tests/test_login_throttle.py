@@ -0,0 +1,48 @@
+"""Wrong passwords, not logins, use up the attempts of a user."""
+
+import pytest
+from bpslibrary.utils.passwords import LoginThrottle, login_throttle
+from conftest import make_classroom_user
+
+
+@pytest.fixture
+def username(session):
+    """Return the username of a user whose password is `secret`."""
+    user, _ = make_classroom_user(session)
+    session.commit()
+    login_throttle.clear()
+    yield user.username
+    login_throttle.clear()
+
+
+def attempt(client, username, password):
+    """Try to log in, returning the status and logging out again."""
+    response = client.post('/users/login', data={'username': username,
+                                                 'password': password})
+    client.get('/users/logout')
+    return response.status_code
+
+
+def test_logins_do_not_use_up_attempts(app, client, username):
+    """A user logs in more often than the burst of wrong passwords."""
+    for _ in range(app.config['LOGIN_USER_BURST'] + 2):
+        assert attempt(client, username, 'secret') == 302
+
+
+def test_wrong_passwords_block_the_user(app, client, username):
+    """Once the wrong passwords are used up, no password is checked."""
+    for _ in range(app.config['LOGIN_USER_BURST']):
+        assert attempt(client, username, 'wrong') == 200
+    assert attempt(client, username, 'secret') == 429
+
+
+def test_buckets_are_bounded():
+    """The least recently used buckets are dropped."""
+    throttle = LoginThrottle(3)
+    for i in range(10):
+        throttle.wait('ip:10.0.0.%d' % i, 1, 1)
+    assert len(throttle) == 3
+    assert throttle.wait('ip:10.0.0.9', 1, 1) > 0
+    assert throttle.wait('ip:10.0.0.0', 1, 1) == 0
+    assert throttle.wait('user:ann', 1, 1, take=False) == 0
+    assert len(throttle) == 3
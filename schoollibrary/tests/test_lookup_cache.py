@@ -0,0 +1,131 @@
+"""The lookup cache evicts by size, records hits in batches and only
+holds answers the providers gave.
+"""
+
+import json
+import os
+from bpslibrary.utils import apihandler, lookupcache
+from bpslibrary.utils.apihandler import APIClient
+from bpslibrary.utils.lookupcache import LookupCache
+from conftest import TEST_DIR
+
+
+def new_cache(name, max_bytes):
+    """Return an empty cache in the test directory."""
+    path = os.path.join(TEST_DIR, name)
+    if os.path.exists(path):
+        os.remove(path)
+    return LookupCache(path, ttl=3600, negative_ttl=60, max_bytes=max_bytes)
+
+
+def stored(cache):
+    """Return the number and size of the stored entries."""
+    return cache._connect().execute(
+        'SELECT count(*), coalesce(sum(size), 0) FROM lookup_cache;'
+    ).fetchone()
+
+
+def test_evictions_are_counted_and_keep_the_cap(monkeypatch):
+    """Entries over the cap are evicted least recently used first."""
+    monkeypatch.setattr(lookupcache, 'EVICT_CHECK_EVERY', 10)
+    monkeypatch.setattr(lookupcache, 'EVICT_BATCH', 2)
+    cache = new_cache('evict.db', max_bytes=250)
+
+    for i in range(10):
+        cache.set('google', 'isbn%d' % i, 'x' * 100)
+        if i == 8:
+            # the first entry is read last, so it is kept
+            assert cache.get('google', 'isbn0')[0]
+
+    count, size = stored(cache)
+    assert size <= 250
+    assert cache.stats['evictions'] == 10 - count
+    assert cache.get('google', 'isbn0')[0]
+
+
+def test_hits_are_recorded_in_batches(monkeypatch):
+    """Reading an entry does not write until a batch of hits is due."""
+    monkeypatch.setattr(lookupcache, 'TOUCH_BATCH', 3)
+    cache = new_cache('touch.db', max_bytes=10 ** 6)
+    cache.set('google', 'isbn', 'x')
+    connection = cache._connect()
+    changes = connection.total_changes
+
+    cache.get('google', 'isbn')
+    cache.get('google', 'isbn')
+    assert connection.total_changes == changes
+
+    cache.set('google', 'other', 'y')
+    cache.set('google', 'third', 'z')
+    changes = connection.total_changes
+    cache.get('google', 'other')
+    assert connection.total_changes == changes
+    cache.get('google', 'third')
+    assert connection.total_changes == changes + 3
+    assert cache.stats['hits'] == 4
+
+
+def test_xisbn_errors_are_not_negative():
+    """Only unknown isbns are cached as not found."""
+    assert APIClient.xisbn_negative('{"stat": "ok"}') is False
+    assert APIClient.xisbn_negative('{"stat": "unknownId"}') is True
+    assert APIClient.xisbn_negative('{"stat": "overlimit"}') is None
+
+
+def test_amazon_errors_are_not_negative():
+    """Only unknown items are cached as not found."""
+    def errors(code):
+        """An ItemLookup response with the error `code`."""
+        return '<ItemLookupResponse><Items><Request><Errors><Error>' \
+            '<Code>%s</Code><Message>...</Message></Error></Errors>' \
+            '</Request></Items></ItemLookupResponse>' % code
+
+    assert APIClient.amazon_negative('<Items><Item/></Items>') is False
+    assert APIClient.amazon_negative(
+        errors('AWS.InvalidParameterValue')) is True
+    assert APIClient.amazon_negative(errors('RequestThrottled')) is None
+    assert APIClient.amazon_negative(
+        errors('SignatureDoesNotMatch')) is None
+    assert APIClient.amazon_negative(errors('InternalError')) is None
+
+
+class FakeResponse():
+    """A google books response of `items` out of `total`."""
+
+    status_code = 200
+
+    def __init__(self, items, total):
+        """Initialise a FakeResponse."""
+        self.items = items
+        self.total = total
+
+    def json(self):
+        """The decoded response."""
+        return {'totalItems': self.total, 'items': self.items}
+
+
+def volume(isbn):
+    """Return a volume identified by `isbn`."""
+    return {'volumeInfo': {'title': isbn, 'industryIdentifiers': [
+        {'type': 'ISBN_13', 'identifier': isbn}]}}
+
+
+def test_google_batches_only_cache_matches(monkeypatch):
+    """ISBNs not matched by identifier are left to their own query."""
+    cache = new_cache('batch.db', 10 ** 6)
+    monkeypatch.setattr(apihandler, 'lookup_cache', cache)
+    isbns = ['9780000000001', '9780000000002', '9780000000003']
+
+    monkeypatch.setattr(apihandler, 'http_get', lambda url, max_wait: (
+        FakeResponse([volume(isbns[0])], 1)))
+    APIClient(None, None).search_google_books_batch(isbns)
+    found, response, negative = cache.get('google', '+isbn:' + isbns[0])
+    assert found and not negative
+    assert json.loads(response)['items'] == [volume(isbns[0])]
+    assert not cache.get('google', '+isbn:' + isbns[1])[0]
+
+    # a partial answer caches nothing
+    monkeypatch.setattr(apihandler, 'http_get', lambda url, max_wait: (
+        FakeResponse([volume(isbns[1])], 50)))
+    APIClient(None, None).search_google_books_batch(isbns[1:])
+    assert not cache.get('google', '+isbn:' + isbns[1])[0]
@@ -0,0 +1,109 @@
+"""The open loan pointers of books agree with the loans table."""
+
+from datetime import date
+from bpslibrary.database import sync_open_loans
+from bpslibrary.models import Book, Classroom, Loan
+from conftest import give_back, lend, make_book, make_classroom_user
+
+
+def scanned_open_loan(book):
+    """The open loan of `book` found by walking its loans."""
+    open_loans = [loan for loan in
+                  sorted(book.loans, key=lambda loan: loan.id, reverse=True)
+                  if not loan.end_date]
+    return open_loans[0] if open_loans else None
+
+
+def walked_open_loans(classroom):
+    """The open loans of `classroom` found by walking its pupils."""
+    loans = []
+    for pupil in classroom.pupils:
+        loans += [loan for loan in pupil.loans if not loan.end_date]
+    return loans
+
+
+def queried_open_loans(session, book):
+    """The ids of the open loans of `book` in the loans table."""
+    return [loan_id for (loan_id,) in session.query(Loan.id).
+            filter(Loan.book_id == book.id, Loan.end_date.is_(None))]
+
+
+def test_open_loan_pointers_match_loans(session):
+    """Open, closed and reopened loans, across two classrooms."""
+    _, class_1 = make_classroom_user(session, 'Class 1', ['Ann', 'Bob'])
+    _, class_2 = make_classroom_user(session, 'Class 2', ['Cat'])
+    ann, bob = class_1.pupils
+    cat = class_2.pupils[0]
+
+    never_lent = make_book(session, 'Never lent')
+    on_loan = make_book(session, 'On loan')
+    returned = make_book(session, 'Returned')
+    reopened = make_book(session, 'Reopened')
+    moved = make_book(session, 'Moved to another class')
+    session.commit()
+
+    lend(session, on_loan, ann, date(2018, 1, 1))
+    lend(session, returned, bob, date(2018, 1, 1))
+    lend(session, reopened, ann, date(2018, 1, 1))
+    lend(session, moved, bob, date(2018, 1, 1))
+    session.commit()
+
+    give_back(returned, date(2018, 1, 8))
+    give_back(reopened, date(2018, 1, 8))
+    give_back(moved, date(2018, 1, 8))
+    session.commit()
+
+    lend(session, reopened, bob, date(2018, 2, 1))
+    lend(session, moved, cat, date(2018, 2, 1))
+    session.commit()
+    session.expire_all()
+
+    books = session.query(Book).order_by(Book.id).all()
+    for book in books:
+        expected = scanned_open_loan(book)
+        assert book.open_loan is expected
+        assert book.current_loan is expected
+        assert book.current_pupil is (expected.pupil if expected else None)
+        assert [loan.id for loan in book.open_loans] == \
+            queried_open_loans(session, book)
+
+    assert never_lent.open_loan is None
+    assert returned.open_loan is None
+    assert reopened.open_loan.pupil is bob
+    assert moved.open_loan.pupil is cat
+
+    for classroom in session.query(Classroom):
+        assert sorted(loan.id for loan in classroom.open_loans) == \
+            sorted(loan.id for loan in walked_open_loans(classroom))
+        for book in books:
+            assert book.is_loaned_to(classroom) == \
+                (scanned_open_loan(book) in walked_open_loans(classroom))
+
+
+def test_sync_open_loans_rebuilds_pointers(session):
+    """The backfill of the pointers gives the same answers."""
+    _, classroom = make_classroom_user(session, 'Class 1', ['Ann'])
+    ann = classroom.pupils[0]
+    reopened = make_book(session, 'Reopened')
+    returned = make_book(session, 'Returned')
+    session.commit()
+
+    lend(session, reopened, ann, date(2018, 1, 1))
+    lend(session, returned, ann, date(2018, 1, 1))
+    session.commit()
+    give_back(reopened, date(2018, 1, 8))
+    give_back(returned, date(2018, 1, 8))
+    session.commit()
+    lend(session, reopened, ann, date(2018, 2, 1))
+    session.commit()
+
+    session.execute(Book.__table__.update().
+                    values(open_loan_id=None, current_pupil_id=None))
+    session.commit()
+    sync_open_loans()
+    session.expire_all()
+
+    for book in session.query(Book):
+        assert book.open_loan is scanned_open_loan(book)
+        assert book.current_pupil is \
+            (book.open_loan.pupil if book.open_loan else None)
@@ -0,0 +1,46 @@
+"""Keyset pages cover every book, and the listing cache stays bounded."""
+
+import pytest
+from bpslibrary.models import Book
+from bpslibrary.utils.pagination import ListingCache, seek_after
+from conftest import make_book
+
+
+@pytest.mark.parametrize('nulls_first', [True, False])
+def test_seek_after_visits_every_book_once(session, nulls_first):
+    """Books with and without titles, in either place of the nulls."""
+    for title in ['B', None, 'A', 'B', None, 'C']:
+        book = make_book(session, title or 'untitled')
+        book.title = title
+    session.commit()
+
+    null_order = Book.title.isnot(None) if nulls_first \
+        else Book.title.is_(None)
+    query = session.query(Book).order_by(null_order, Book.title, Book.id)
+    expected = [book.id for book in query]
+
+    seen, last_key = [], None
+    while True:
+        page = query
+        if last_key is not None:
+            page = page.filter(seek_after(Book, last_key, nulls_first))
+        books = page.limit(2).all()
+        if not books:
+            break
+        seen += [book.id for book in books]
+        last_key = (books[-1].title, books[-1].id)
+    assert seen == expected
+
+
+def test_listings_are_bounded():
+    """The least recently used listings are dropped."""
+    cache = ListingCache(60, max_listings=3)
+    for i in range(10):
+        cache.total(('search', 'term %d' % i), lambda: 1)
+    assert len(cache) == 3
+
+    cache.total(('search', 'term 7'), lambda: 1)
+    cache.total(('search', 'new'), lambda: 1)
+    counted = []
+    cache.total(('search', 'term 7'), lambda: counted.append(1) or 1)
+    assert not counted and len(cache) == 3
@@ -0,0 +1,30 @@
+"""Callers that cannot wait long are refused rather than kept waiting."""
+
+import time
+import pytest
+from bpslibrary.utils import apihandler
+from bpslibrary.utils.apihandler import APIClient
+from bpslibrary.utils.ratelimit import RateLimitExceeded, rate_limiter
+
+
+def test_acquire_raises_beyond_max_wait():
+    """No token is taken when the wait is refused."""
+    rate_limiter.acquire('max-wait.example', 0.05, 1)
+    started = time.time()
+    with pytest.raises(RateLimitExceeded):
+        rate_limiter.acquire('max-wait.example', 0.05, 1, max_wait=1)
+    assert time.time() - started < 1
+    assert rate_limiter.try_acquire('max-wait.example', 0.05, 1) > 19
+
+
+def test_rate_limited_provider_is_skipped(monkeypatch):
+    """The lookup goes on without the provider, noting it was skipped."""
+    def refused(url, max_wait=None, **kwargs):
+        """A provider whose next call is a minute away."""
+        assert max_wait == 5
+        raise RateLimitExceeded('svcs.ebay.com is rate limited')
+
+    monkeypatch.setattr(apihandler, 'http_get', refused)
+    client = APIClient(['9780000000002'], None, max_wait=5)
+    assert client.lookup_title('9780000000002') is None
+    assert 'svcs.ebay.com is rate limited' in client.errors[0]
@@ -0,0 +1,79 @@
+"""Roster imports add, keep and remove pupils by classroom and name."""
+
+import io
+from bpslibrary.models import Classroom, Pupil, User
+from bpslibrary.utils.roster import import_roster
+from conftest import login
+
+
+def roster(*rows):
+    """Return a CSV file of `rows`."""
+    return io.StringIO(''.join('%s,%d,%s\n' % row for row in rows))
+
+
+def class_pupils(session, name):
+    """Return the sorted pupil names of the classroom `name`."""
+    return sorted(p for (p,) in session.query(Pupil.name).
+                  join(Classroom).filter(Classroom.name == name))
+
+
+def test_pupils_sharing_a_name_are_both_added(session):
+    """Two pupils of one name in a class are two pupils."""
+    report = import_roster(session, roster(
+        ('Owls', 3, 'Sam Lee'), ('Owls', 3, 'Sam Lee'), ('Owls', 3, 'Amy')))
+
+    assert report.pupils_added == 3
+    assert class_pupils(session, 'Owls') == ['Amy', 'Sam Lee', 'Sam Lee']
+
+
+def test_uploading_a_roster_again_adds_nothing(session):
+    """The pupils of a class are matched against the database."""
+    rows = [('Owls', 3, 'Sam Lee'), ('Owls', 3, 'Sam Lee'),
+            ('Foxes', 4, 'Amy')]
+    import_roster(session, roster(*rows))
+    report = import_roster(session, roster(*rows))
+
+    assert report.pupils_added == 0
+    assert report.classrooms_added == 0
+    assert class_pupils(session, 'Owls') == ['Sam Lee', 'Sam Lee']
+
+
+def test_replace_removes_one_of_two_pupils_sharing_a_name(session):
+    """Replacing keeps as many pupils of a name as the file lists."""
+    import_roster(session, roster(
+        ('Owls', 3, 'Sam Lee'), ('Owls', 3, 'Sam Lee'), ('Owls', 3, 'Amy')))
+    report = import_roster(session, roster(
+        ('Owls', 3, 'Sam Lee'), ('Owls', 3, 'Amy')), replace=True)
+
+    assert report.pupils_added == 0
+    assert report.pupils_removed == 1
+    assert class_pupils(session, 'Owls') == ['Amy', 'Sam Lee']
+
+
+def test_invalid_rows_are_reported(session):
+    """Rows without a valid year are skipped and reported."""
+    report = import_roster(session, io.StringIO(
+        'Owls,3,Amy\nOwls,three,<b>Sam</b>\n'))
+
+    assert report.pupils_added == 1
+    assert report.errors == [(2, "Invalid year 'three'.")]
+
+
+def test_row_errors_are_escaped_in_the_flash(session, client):
+    """The text of invalid rows is not rendered as markup."""
+    admin = User()
+    admin.username = 'admin'
+    admin.password = 'secret'
+    admin.is_admin = True
+    session.add(admin)
+    session.commit()
+    login(client, admin.id)
+
+    client.post('/users/update', data={
+        'classroom_file': (io.BytesIO(b'Owls,<i>3</i>,Amy\n'), 'owls.csv')},
+                content_type='multipart/form-data')
+    with client.session_transaction() as flask_session:
+        messages = [m for _, m in flask_session['_flashes']]
+
+    assert "Line 1: Invalid year &#39;&lt;i&gt;3&lt;/i&gt;&#39;." in \
+        messages[0]